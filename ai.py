@@ -0,0 +1,84 @@
+"""ai.py - Computer player.
+
+Every position reachable from the empty board is solved by negamax the
+first time the computer plays perfectly on an instance (or at warmup, see
+warmup.py), and the best reply to each is kept in a table indexed by the
+board's base 3 encoding (see engine.py), so a perfect reply is a table
+lookup. Among equally good moves the solver prefers the quickest win and
+the slowest loss."""
+
+import random
+import threading
+
+import engine
+
+EASY = 'easy'
+MEDIUM = 'medium'
+PERFECT = 'perfect'
+LEVELS = (EASY, MEDIUM, PERFECT)
+
+_NO_MOVE = 0xFF
+
+
+def _solve():
+    """Returns the table of best replies"""
+    best = bytearray([_NO_MOVE]) * (3 ** engine.SIZE)
+    values = {}
+
+    def negamax(board, player):
+        """Returns the value of board for the player to move"""
+        code = engine.encode(board)
+        if code in values:
+            return values[code]
+        outcome = engine.outcome(board)
+        free = len(engine.legal_moves(board))
+        if outcome == engine.DRAW:
+            value = 0
+        elif outcome != engine.IN_PROGRESS:
+            value = -(free + 1)  # The previous move won
+        else:
+            value = None
+            for cell in engine.legal_moves(board):
+                reply = -negamax(engine.place(board, cell, player), 1 - player)
+                if value is None or reply > value:
+                    value = reply
+                    best[code] = cell
+        values[code] = value
+        return value
+
+    negamax(engine.EMPTY, engine.X)
+    return best
+
+
+_lock = threading.Lock()
+_best = []  # Holds the table of best replies once it is built
+
+
+def best_replies():
+    """Returns the table of best replies, building it on first use"""
+    if not _best:
+        with _lock:
+            if not _best:
+                _best.append(_solve())
+    return _best[0]
+
+
+def perfect_reply(board):
+    """Returns the best cell to play on a board reachable in a game"""
+    return best_replies()[engine.encode(board)]
+
+
+def reply(board, player, level):
+    """Returns the cell the computer plays as player (engine.X or engine.O)
+    at a level"""
+    moves = engine.legal_moves(board)
+    if level == PERFECT:
+        return perfect_reply(board)
+    if level == MEDIUM:
+        # Win if possible, otherwise block the opponent's win
+        for mover in (player, 1 - player):
+            for cell in moves:
+                if engine.outcome(engine.place(board, cell, mover)) in (
+                        engine.X_WINS, engine.O_WINS):
+                    return cell
+    return random.choice(moves)
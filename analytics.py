@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""analytics.py - Game statistics over an archive of finished games.
+
+Loads an archive written by the export (see archive.py and export.py) into
+NumPy arrays and computes, without a Python loop over the games, the win
+rates of each opening move, the average game length and the advantage of
+the first player. Runs offline, outside App Engine. Usage:
+
+    python analytics.py games.archive [--board-size 3]
+"""
+
+import argparse
+import json
+
+import numpy
+
+import archive
+
+_DTYPES = {'q': '<i8', 'i': '<i4', 'B': 'u1', 'H': '<u2'}
+
+
+def load(path):
+    """Returns a dict of column name to array of an archive. Besides the
+    archive.COLUMNS it holds 'moves', the moves of every game concatenated,
+    and 'offsets', where the moves of each game start in 'moves'."""
+    columns = dict((name, []) for name, code in archive.COLUMNS)
+    moves = []
+    with open(path, 'rb') as archive_file:
+        archive.read_header(archive_file)
+        for count, block, block_moves in archive.read_blocks(archive_file):
+            for name, code in archive.COLUMNS:
+                columns[name].append(numpy.frombuffer(block[name],
+                                                      dtype=_DTYPES[code]))
+            moves.append(numpy.frombuffer(block_moves, dtype='u1'))
+    games = {}
+    for name, code in archive.COLUMNS:
+        games[name] = numpy.concatenate(
+                columns[name] or [numpy.zeros(0, dtype=_DTYPES[code])])
+    games['moves'] = numpy.concatenate(moves or [numpy.zeros(0, dtype='u1')])
+    lengths = games['moves_count'].astype('i8')
+    games['offsets'] = numpy.cumsum(lengths) - lengths
+    return games
+
+
+def _rates(part, whole):
+    """Returns part / whole, with None where whole is 0"""
+    return [round(float(p) / w, 4) if w else None
+            for p, w in zip(part, whole)]
+
+
+def opening_win_rates(games, board_size=3):
+    """Returns the number of games and the X win, O win and draw rates of
+    each opening cell of the games on a board_size board"""
+    selected = ((games['board_size'] == board_size) &
+                (games['moves_count'] > 0) &
+                (games['result'] != archive.RESULT_UNKNOWN))
+    openings = games['moves'][games['offsets'][selected]]
+    results = games['result'][selected]
+    cells = board_size * board_size
+    counts = numpy.bincount(openings, minlength=cells)
+    rates = {}
+    for name, result in (('x_wins', archive.RESULT_X_WINS),
+                         ('o_wins', archive.RESULT_O_WINS),
+                         ('draws', archive.RESULT_DRAW)):
+        rates[name] = _rates(numpy.bincount(
+                openings, weights=results == result, minlength=cells), counts)
+    return dict((cell, {'games': int(counts[cell]),
+                        'x_wins': rates['x_wins'][cell],
+                        'o_wins': rates['o_wins'][cell],
+                        'draws': rates['draws'][cell]})
+                for cell in range(cells))
+
+
+def average_length(games):
+    """Returns the average number of moves of the games of each board
+    size"""
+    sizes = games['board_size']
+    totals = numpy.bincount(sizes, weights=games['moves_count'])
+    counts = numpy.bincount(sizes)
+    return dict((int(size), round(float(totals[size]) / counts[size], 3))
+                for size in numpy.nonzero(counts)[0])
+
+
+def first_player_advantage(games):
+    """Returns the X win rate, O win rate and their difference over the
+    games of each board size whose result is known"""
+    known = games['result'] != archive.RESULT_UNKNOWN
+    sizes = games['board_size'][known]
+    results = games['result'][known]
+    counts = numpy.bincount(sizes)
+    x_wins = numpy.bincount(sizes, weights=results == archive.RESULT_X_WINS,
+                            minlength=len(counts))
+    o_wins = numpy.bincount(sizes, weights=results == archive.RESULT_O_WINS,
+                            minlength=len(counts))
+    advantage = {}
+    for size in numpy.nonzero(counts)[0]:
+        x_rate = float(x_wins[size]) / counts[size]
+        o_rate = float(o_wins[size]) / counts[size]
+        advantage[int(size)] = {'games': int(counts[size]),
+                                'x_win_rate': round(x_rate, 4),
+                                'o_win_rate': round(o_rate, 4),
+                                'advantage': round(x_rate - o_rate, 4)}
+    return advantage
+
+
+def report(games, board_size=3):
+    """Returns every statistic of an archive as a JSON serializable dict"""
+    return {
+        'games': len(games['game_id']),
+        'opening_win_rates': opening_win_rates(games, board_size),
+        'average_length': average_length(games),
+        'first_player_advantage': first_player_advantage(games),
+    }
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('archive', help='Archive file of the export')
+    parser.add_argument('--board-size', type=int, default=3,
+                        help='Board size of the opening move statistics')
+    options = parser.parse_args()
+    print(json.dumps(report(load(options.archive), options.board_size),
+                     indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    _main()
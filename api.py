@@ -2,36 +2,138 @@
 """api.py - Create and configure the Game API exposing the resources.
 This can also contain game logic. For more complex games it would be wise to
 move game logic to another file. Ideally the API will be simple, concerned
-primarily with communication to/from the API's users."""
+primarily with communication to/from the API's users.
+
+The computer player and tournaments are imported by the methods that use
+them, so a cold instance does not load them for other requests."""
 
 
 import logging
 import endpoints
 import re
-from protorpc import remote, messages
+import time
+from protorpc import remote, messages, protobuf
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 from settings import WEB_CLIENT_ID
 
-from models import UserGame, User, Game  
+import counters
+import engine
+import etags
+import gamecache
+import leaderboard
+import profiling
+
+from models import UserGame, User, Game, MoveRecord, ArchivedGame, \
+    Tournament, StaleGameError
 from models import StringMessage, NewGameForm, GameForm, GameForms, \
-    MakeMoveForm, UserGameForm, UserGameForms, UserRankingForm, UserRankingForms
-from utils import get_by_urlsafe
+    MakeMoveForm, UserGameForm, UserGameForms, UserRankingForm, UserRankingForms, \
+    MoveRecordForms, NewTournamentForm, TournamentForm
+from models import ACTIVE_GAMES, ACTIVE_MOVES, COMPUTER_NAME
+from models import MOVE_MESSAGES, MOVE_NO_WINNER, MOVE_WIN, MOVE_DRAW, \
+    MOVE_WRONG_TURN_X, MOVE_WRONG_TURN_O, MOVE_INVALID, MOVE_TAKEN
+from utils import get_by_urlsafe, get_by_urlsafe_async, fetch_page, \
+    page_list, DEFAULT_PAGE_SIZE
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        etag=messages.StringField(2),)
+CANCEL_GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
+WAIT_FOR_MOVE_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        moves_count=messages.IntegerField(2, required=True),
+        timeout=messages.IntegerField(3),)
+GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        limit=messages.IntegerField(2),
+        cursor=messages.StringField(3),
+        etag=messages.StringField(4),)
+GET_TOURNAMENT_REQUEST = endpoints.ResourceContainer(
+        urlsafe_tournament_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+PAGE_REQUEST = endpoints.ResourceContainer(limit=messages.IntegerField(1),
+                                           cursor=messages.StringField(2),
+                                           etag=messages.StringField(3))
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+        user_name=messages.StringField(1),
+        limit=messages.IntegerField(2),
+        cursor=messages.StringField(3),)
+
+# Only the properties the forms need are fetched
+SCORE_PROJECTION = [UserGame.user, UserGame.game_key, UserGame.win_status,
+                    UserGame.moves_count]
+USER_GAME_PROJECTION = [UserGame.game_key, UserGame.win_status,
+                        UserGame.moves_count]
+RANKING_PROJECTION = [User.name, User.nbr_wins, User.nbr_loses,
+                      User.winning_percentage_rate,
+                      User.average_game_moves_on_winning_games]
+
+TOP_RANKINGS_TTL = 60
+NOT_MODIFIED_MESSAGE = 'Not modified.'
+DEFAULT_WAIT_TIMEOUT = 20
+MAX_WAIT_TIMEOUT = 50  # Requests are cut off after 60 seconds
+DEFAULT_WIN_LENGTH = 5  # Five in a row on boards of 5 x 5 and up
+COMPUTER_NAME_MESSAGE = 'The computer only plays through ai_level.'
+STALE_GAME_MESSAGE = 'The game was changed by another move. Reload it and try again.'
+COMPUTER_MESSAGES = {
+    MOVE_NO_WINNER: 'The computer played {}.  Good luck on your next move.',
+    MOVE_WIN: 'The computer played {}.  The computer wins!',
+    MOVE_DRAW: 'The computer played {}.  Game over! No winner.',
+}
+
+
+def _get_archived(urlsafe_game_key):
+    """Returns the ArchivedGame of a game that is no longer a Game. Raises
+    NotFoundException if there is none."""
+    archived = ArchivedGame.key_for(ndb.Key(urlsafe=urlsafe_game_key)).get()
+    if not archived:
+        raise endpoints.NotFoundException('Game not found!')
+    return archived
+
+
+def _game_state(urlsafe_game_key):
+    """Returns the GameState of a game from the game cache, the datastore
+    or the archive. Raises NotFoundException if there is no such game."""
+    state = gamecache.get(urlsafe_game_key)
+    if state:
+        return state
+    game = get_by_urlsafe(urlsafe_game_key, Game)
+    if game:
+        return gamecache.add(game)
+    return _get_archived(urlsafe_game_key).state()
+
+
+def _rankings_page(limit, cursor):
+    """Returns a page of user rankings, best first. Users without a rank
+    score, such as the computer, are left out."""
+    query = User.query(User.rank_score >= 0).order(-User.rank_score)
+    users, next_cursor = fetch_page(query, limit, cursor,
+                                    projection=RANKING_PROJECTION)
+    return UserRankingForms(items=[user.rank_form() for user in users],
+                            next_cursor=next_cursor)
+
+
+def top_rankings():
+    """Returns the first page of user rankings. Served from memcache until
+    a game ends or TOP_RANKINGS_TTL passes."""
+    cached = memcache.get(leaderboard.MEMCACHE_TOP_RANKINGS)
+    if cached:
+        return protobuf.decode_message(UserRankingForms, cached)
+    forms = _rankings_page(DEFAULT_PAGE_SIZE, None)
+    memcache.set(leaderboard.MEMCACHE_TOP_RANKINGS,
+                 protobuf.encode_message(forms), TOP_RANKINGS_TTL)
+    return forms
 
-MEMCACHE_MOVES = 'MOVES'
 
 @endpoints.api(name='tictactoe', version='v1',
     allowed_client_ids=[WEB_CLIENT_ID, API_EXPLORER_CLIENT_ID],
@@ -43,16 +145,15 @@ class TicTacToeApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @profiling.timed()
     def create_user(self, request):
         """Create a User. Requires a unique username"""
         if not re.search(r'[\w.-]+@[\w.-]+.\w+',request.email):
             raise endpoints.ConflictException(
                     'Email address must be valid!')
-        if User.query(User.name == request.user_name).fetch(keys_only=True):
+        if not User.create(request.user_name, request.email):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -61,18 +162,55 @@ class TicTacToeApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @profiling.timed()
     def new_game(self, request):
         """Creates new game"""
-        x_user = User.query(User.name == request.x_user_name).get()
-        o_user = User.query(User.name == request.o_user_name).get()
+        if COMPUTER_NAME in (request.x_user_name, request.o_user_name):
+            raise endpoints.BadRequestException(COMPUTER_NAME_MESSAGE)
+        x_user = o_user = None
+        board_size = request.board_size or engine.BOARD_SIZE
+        win_length = request.win_length or min(board_size, DEFAULT_WIN_LENGTH)
+        if not engine.BOARD_SIZE <= board_size <= engine.MAX_BOARD_SIZE:
+            raise endpoints.BadRequestException(
+                    'board_size must be from {} to {}.'.format(
+                            engine.BOARD_SIZE, engine.MAX_BOARD_SIZE))
+        if not engine.WIN_LENGTH <= win_length <= board_size:
+            raise endpoints.BadRequestException(
+                    'win_length must be from {} to board_size.'.format(
+                            engine.WIN_LENGTH))
+        # The two names are resolved concurrently
+        x_future = User.key_for_name_async(request.x_user_name)
+        o_future = User.key_for_name_async(request.o_user_name)
+        if request.ai_level:
+            import ai
+            if request.ai_level not in ai.LEVELS:
+                raise endpoints.BadRequestException(
+                        'ai_level must be one of {}.'.format(', '.join(ai.LEVELS)))
+            if (board_size, win_length) != (engine.BOARD_SIZE,
+                                            engine.WIN_LENGTH):
+                raise endpoints.BadRequestException(
+                        'The computer only plays 3 in a row on a 3 x 3 board.')
+            if bool(request.x_user_name) == bool(request.o_user_name):
+                raise endpoints.BadRequestException(
+                        'Give exactly one user name to play the computer.')
+            if request.x_user_name:
+                o_user = User.computer_key()
+            else:
+                x_user = User.computer_key()
+        x_user = x_user or x_future.get_result()
+        o_user = o_user or o_future.get_result()
         if not x_user:
             raise endpoints.NotFoundException(
                     'X User with that name does not exist!')
         if not o_user:
             raise endpoints.NotFoundException(
                     'O User with that name does not exist!')
-        game_moves = ['B','B','B','B','B','B','B','B','B']    
-        game = Game.new_game(x_user.key, o_user.key, game_moves)
+        game = Game.new_game(x_user, o_user, request.ai_level,
+                             board_size, win_length)
+        if game.computer_to_move():
+            cell, status = game.play_computer()
+            game.commit(1)
+            return game.to_form(COMPUTER_MESSAGES[status].format(cell))
         return game.to_form('Good luck playing Guess a Number!')
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
@@ -80,205 +218,343 @@ class TicTacToeApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @profiling.timed()
     def get_game(self, request):
-        """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            return game.to_form('You got game!')
-        else:
-            raise endpoints.NotFoundException('Game not found!')
+        """Return the current game state. Served from the game cache, so
+        polling does not touch the datastore. Only returns not_modified if
+        the etag given is still current."""
+        state = _game_state(request.urlsafe_game_key)
+        if request.etag and request.etag == state.etag(
+                request.urlsafe_game_key):
+            return GameForm(urlsafe_key=request.urlsafe_game_key,
+                            message=NOT_MODIFIED_MESSAGE,
+                            etag=request.etag,
+                            not_modified=True)
+        return state.to_form(request.urlsafe_game_key, 'You got game!')
+
+    @endpoints.method(request_message=WAIT_FOR_MOVE_REQUEST,
+                      response_message=GameForm,
+                      path='game/wait/{urlsafe_game_key}',
+                      name='wait_for_move',
+                      http_method='GET')
+    @profiling.timed()
+    def wait_for_move(self, request):
+        """Waits until the game's moves_count differs from the given one, or
+        the timeout (in seconds) passes. Returns the game state."""
+        timeout = min(request.timeout or DEFAULT_WAIT_TIMEOUT,
+                      MAX_WAIT_TIMEOUT)
+        deadline = time.time() + timeout
+        state = _game_state(request.urlsafe_game_key)
+        while True:
+            if state.moves_count != request.moves_count:
+                return state.to_form(request.urlsafe_game_key,
+                                     'The game has a new move!')
+            if state.game_over:
+                return state.to_form(request.urlsafe_game_key,
+                                     'Game already over!')
+            # Re-seeds a change marker evicted from memcache, so the wait
+            # polls the marker rather than the whole state
+            gamecache.seed_marker(request.urlsafe_game_key, state.moves_count)
+            changed = gamecache.wait_for_move(request.urlsafe_game_key,
+                                              request.moves_count, deadline)
+            state = _game_state(request.urlsafe_game_key)
+            if state.moves_count == request.moves_count and (
+                    changed is False or time.time() >= deadline):
+                return state.to_form(request.urlsafe_game_key,
+                                     'No new move yet.')
+            if state.moves_count == request.moves_count:
+                # The marker was missing or ahead of the cached state
+                time.sleep(gamecache.POLL_INTERVAL)
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/make_a_move/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @profiling.timed()
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
+        if request.user_name == COMPUTER_NAME:
+            raise endpoints.BadRequestException(COMPUTER_NAME_MESSAGE)
+
+        # The game and the user are looked up concurrently
+        game_future = get_by_urlsafe_async(request.urlsafe_game_key, Game)
+        user_future = User.key_for_name_async(request.user_name)
 
         # Checks if game request is valid
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = game_future.get_result()
+        if not game:
+            archived = _get_archived(request.urlsafe_game_key)
+            return archived.state().to_form(request.urlsafe_game_key,
+                                            'Game already over!')
+        game.prefetch_names()
+        if (request.expected_version is not None and
+                request.expected_version != game.version):
+            raise endpoints.ConflictException(STALE_GAME_MESSAGE)
         if game.game_over:
             return game.to_form('Game already over!')
 
         #  Checks if user request is valid
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        user_key = user_future.get_result()
+        if not user_key:
             raise endpoints.NotFoundException(
                     'User with that name does not exist!')
-        if user.key != game.x_user and user.key != game.o_user: 
+        if user_key != game.x_user and user_key != game.o_user: 
             raise endpoints.NotFoundException(
                     'User is not a player of the game!')
 
         # Checks if move is valid    
         tmp_moves_count = game.moves_count + 1 
-        if tmp_moves_count % 2 == 0 and user.key != game.o_user:  #Even move means o_user move
-            msg = 'Move rejected.  Next move must be from o_user.'
-            game.post_history(user.key, tmp_moves_count, request.move, msg)
-            raise endpoints.NotFoundException(msg)
-        if tmp_moves_count % 2 != 0 and user.key != game.x_user:  #Odd move means x_user move
-            msg = 'Move rejected.  Next move must be from x_user.'
-            game.post_history(user.key, tmp_moves_count, request.move, msg)
-            raise endpoints.NotFoundException(msg)
+        if tmp_moves_count % 2 == 0 and user_key != game.o_user:  #Even move means o_user move
+            status = MOVE_WRONG_TURN_O
+            game.post_rejected_move(user_key, tmp_moves_count, request.move, status)
+            raise endpoints.NotFoundException(MOVE_MESSAGES[status])
+        if tmp_moves_count % 2 != 0 and user_key != game.x_user:  #Odd move means x_user move
+            status = MOVE_WRONG_TURN_X
+            game.post_rejected_move(user_key, tmp_moves_count, request.move, status)
+            raise endpoints.NotFoundException(MOVE_MESSAGES[status])
         move_int = int(request.move)
-        if move_int < 0 or move_int > 8:
-            msg = 'Invalid row move! Choose 0 to 8.'
-            game.post_history(user.key, tmp_moves_count, request.move, msg)
-            raise endpoints.NotFoundException(msg)
-        if game.game_moves[move_int] != 'B':
-            msg = 'Move is not longer available.'
-            game.post_history(user.key, tmp_moves_count, request.move, msg)
-            return game.to_form(msg)
+        if not game.is_cell(move_int):
+            status = MOVE_INVALID
+            game.post_rejected_move(user_key, tmp_moves_count, request.move, status)
+            raise endpoints.NotFoundException(
+                    'Invalid row move! Choose 0 to {}.'.format(
+                            game.board_size ** 2 - 1))
+        if not game.is_free(move_int):
+            status = MOVE_TAKEN
+            game.post_rejected_move(user_key, tmp_moves_count, request.move, status)
+            return game.to_form(MOVE_MESSAGES[status])
 
         # Process move        
-        game.moves_count += 1 
-        if user.key == game.x_user: 
-            game.game_moves[move_int] = "X"
-        else: 
-            game.game_moves[move_int] = "O"   
-        if self._check_winning_combination(game.game_moves):
-            msg = 'You win!'
-            game.post_history(user.key, game.moves_count, request.move, msg)
-            winner = user.key
-            game.end_game(winner)
-            return game.to_form(msg)
-        if game.moves_count >= 9:
-            msg = 'Game over! No winner.'
-            game.post_history(user.key, game.moves_count, request.move, msg)
-            winner = ""
-            game.end_game(winner)
-            return game.to_form(msg)
-        else:
-            msg = 'No winner yet.  Good luck on your next move.'
-            game.post_history(user.key, game.moves_count, request.move, msg)
-            game.put()
-            return game.to_form(msg)      
-
-
-    def _check_winning_combination(self, game_moves):
-      """Checks if the winning combination is found."""
-      if game_moves[0] != 'B':
-          if game_moves[0] == game_moves[1] and game_moves[0] == game_moves[2]:
-              return True
-          if game_moves[0] == game_moves[3] and game_moves[0] == game_moves[6]:
-              return True    
-          if game_moves[0] == game_moves[4] and game_moves[0] == game_moves[8]:
-              return True
-
-      if game_moves[1] != 'B':
-          if game_moves[1] == game_moves[4] and game_moves[1] == game_moves[7]:
-              return True
-
-      if game_moves[2] != 'B':
-          if game_moves[2] == game_moves[5] and game_moves[2] == game_moves[8]:
-              return True
-
-      if game_moves[3] != 'B':
-          if game_moves[3] == game_moves[4] and game_moves[3] == game_moves[5]:
-              return True        
-
-      if game_moves[6] != 'B':
-          if game_moves[6] == game_moves[7] and game_moves[6] == game_moves[8]:
-              return True 
-          if game_moves[6] == game_moves[4] and game_moves[6] == game_moves[2]:
-              return True            
-      return False          
-
-    @endpoints.method(response_message=UserGameForms,
+        moves_made = 1
+        status = game.apply_move(user_key, move_int)
+        message = MOVE_MESSAGES[status]
+        winner = user_key if status == MOVE_WIN else ""
+        if status == MOVE_NO_WINNER and game.computer_to_move():
+            computer_key = game.next_user()
+            cell, status = game.play_computer()
+            moves_made += 1
+            message = COMPUTER_MESSAGES[status].format(cell)
+            winner = computer_key if status == MOVE_WIN else ""
+        try:
+            if status == MOVE_NO_WINNER:
+                game.commit(moves_made)
+            else:
+                game.end_game(winner, moves_made)
+        except StaleGameError:
+            raise endpoints.ConflictException(STALE_GAME_MESSAGE)
+        return game.to_form(message)
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserGameForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @profiling.timed()
     def get_scores(self, request):
-        """Return all scores"""
-        usergames = UserGame.query(UserGame.game_over == True)
-        return UserGameForms(items=[usergame.to_form() for usergame in usergames])
+        """Return a page of all scores, or not_modified if the etag given
+        is still current"""
+        etag = etags.make(etags.versions([etags.SCORES])[etags.SCORES],
+                          request.limit, request.cursor)
+        if request.etag == etag:
+            return UserGameForms(etag=etag, not_modified=True)
+        usergames, next_cursor = fetch_page(
+                UserGame.query(UserGame.game_over == True),
+                request.limit, request.cursor, projection=SCORE_PROJECTION)
+        return UserGameForms(items=UserGame.to_forms(usergames, True),
+                             next_cursor=next_cursor, etag=etag)
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=UserGameForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @profiling.timed()
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        """Returns a page of an individual User's scores"""
+        user_key = User.key_for_name(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        usergames = UserGame.query(UserGame.user == user.key, UserGame.game_over == True)
-        return UserGameForms(items=[usergame.to_form() for usergame in usergames])
+        usergames, next_cursor = fetch_page(
+                UserGame.query(UserGame.user == user_key, UserGame.game_over == True),
+                request.limit, request.cursor, projection=USER_GAME_PROJECTION)
+        return UserGameForms(
+                items=UserGame.to_forms(usergames, True, request.user_name),
+                next_cursor=next_cursor)
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_moves',
                       name='get_average_moves',
                       http_method='GET')
+    @profiling.timed()
     def get_average_moves(self, request):
-        """Get the cached average moves"""
-        return StringMessage(message=memcache.get(MEMCACHE_MOVES) or '')
+        """Get the average moves of active games"""
+        counts = counters.get_counts([ACTIVE_GAMES, ACTIVE_MOVES])
+        if counts[ACTIVE_GAMES] <= 0:
+            return StringMessage(message='')
+        average = float(counts[ACTIVE_MOVES])/counts[ACTIVE_GAMES]
+        return StringMessage(message='The average moves is {:.2f}'.format(average))
 
     @staticmethod
     def _cache_average_moves():
-        """Populates memcache with the average moves of active Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_moves = sum([game.moves_count for game in games])
-            average = float(total_moves)/count
-            memcache.set(MEMCACHE_MOVES,
-                         'The average moves is {:.2f}'.format(average))
+        """Recounts the active games and their moves into the counters behind
+        get_average_moves"""
+        Game.recount_active()
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=UserGameForms,
                       path='games/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @profiling.timed()
     def get_user_games(self, request):
-        """Returns all active games of user"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        """Returns a page of the active games of user"""
+        user_key = User.key_for_name(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        usergames = UserGame.query(UserGame.user == user.key, UserGame.game_over == False)
-        return UserGameForms(items=[usergame.to_form() for usergame in usergames])
+        usergames, next_cursor = fetch_page(
+                UserGame.query(UserGame.user == user_key, UserGame.game_over == False),
+                request.limit, request.cursor, projection=USER_GAME_PROJECTION)
+        return UserGameForms(
+                items=UserGame.to_forms(usergames, False, request.user_name),
+                next_cursor=next_cursor)
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=CANCEL_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/cancel_game/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @profiling.timed()
     def cancel_game(self, request):
         """Cancel game."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game:
-            raise endpoints.NotFoundException('Game not found!')
+            _get_archived(request.urlsafe_game_key)
+            raise endpoints.NotFoundException(
+                    'Can not cancel game.  Game is over.')
         if game.game_over:     
             raise endpoints.NotFoundException('Can not cancel game.  Game is over.')
+        if game.tournament_match:
+            raise endpoints.BadRequestException(
+                    'Can not cancel a game of a bracket tournament.')
 
         game.cancel_game()
         return game.to_form('Game cancelled!')
 
-    @endpoints.method(response_message=UserRankingForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserRankingForms,
                       path='user_rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @profiling.timed()
     def get_user_rankings(self, request):
-        """Get user rankings."""
-        users = User.query().order(-User.winning_percentage_rate, -User.nbr_wins, User.average_game_moves_on_winning_games)
-        return UserRankingForms(items=[user.rank_form() for user in users])   
+        """Get a page of user rankings, or not_modified if the etag given
+        is still current. The first page is served from memcache until a
+        game ends."""
+        etag = etags.make(
+                etags.versions([etags.LEADERBOARD])[etags.LEADERBOARD],
+                request.limit, request.cursor)
+        if request.etag == etag:
+            return UserRankingForms(etag=etag, not_modified=True)
+        if not request.cursor and request.limit in (None, DEFAULT_PAGE_SIZE):
+            forms = top_rankings()
+        else:
+            forms = _rankings_page(request.limit, request.cursor)
+        forms.etag = etag
+        return forms
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
-                      response_message=StringMessage,
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=UserRankingForm,
+                      path='user_rankings/{user_name}',
+                      name='get_user_rank',
+                      http_method='GET')
+    @profiling.timed()
+    def get_user_rank(self, request):
+        """Get the ranking of a user."""
+        user_key = User.key_for_name(request.user_name)
+        if not user_key:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        user = user_key.get()
+        form = user.rank_form()
+        if user.rank_score is None:
+            form.rank = leaderboard.rank(leaderboard.score(user))
+        else:
+            form.rank = leaderboard.rank(user.rank_score)
+        return form
+
+    @endpoints.method(request_message=GAME_HISTORY_REQUEST,
+                      response_message=MoveRecordForms,
                       path='game/history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @profiling.timed()
     def get_game_history(self, request):
-        """Get history of game."""
+        """Get a page of the history of game, oldest move first, or
+        not_modified if the etag given is still current."""
+        version_name = etags.history(request.urlsafe_game_key)
+        etag = etags.make(etags.versions([version_name])[version_name],
+                          request.limit, request.cursor)
+        if request.etag == etag:
+            return MoveRecordForms(etag=etag, not_modified=True)
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if game:
-            if game.history: 
-                return StringMessage(message=str(game.history))
-            else:
-                return StringMessage('No game history found.')     
+            records, next_cursor = fetch_page(MoveRecord.query_game(game.key),
+                                              request.limit, request.cursor)
         else:
-            raise endpoints.NotFoundException('Game not found!')    
+            records, next_cursor = page_list(
+                    _get_archived(request.urlsafe_game_key).history,
+                    request.limit, request.cursor)
+        return MoveRecordForms(items=MoveRecord.to_forms(records),
+                               next_cursor=next_cursor, etag=etag)
+
+    @endpoints.method(request_message=NewTournamentForm,
+                      response_message=TournamentForm,
+                      path='tournament',
+                      name='create_tournament',
+                      http_method='POST')
+    @profiling.timed()
+    def create_tournament(self, request):
+        """Creates a tournament and its games. All users are looked up and
+        all games written in a few batch calls."""
+        import tournaments
+        if request.format not in tournaments.FORMATS:
+            raise endpoints.BadRequestException(
+                    'format must be one of {}.'.format(
+                            ', '.join(tournaments.FORMATS)))
+        names = request.user_names
+        if not 2 <= len(names) <= tournaments.MAX_PLAYERS:
+            raise endpoints.BadRequestException(
+                    'A tournament needs 2 to {} users.'.format(
+                            tournaments.MAX_PLAYERS))
+        if len(set(names)) != len(names) or not all(names):
+            raise endpoints.BadRequestException(
+                    'Give each user name once.')
+        user_keys = User.keys_for_names(names)
+        missing = [name for name, key in zip(names, user_keys) if not key]
+        if missing:
+            raise endpoints.NotFoundException(
+                    'Users with these names do not exist: {}'.format(
+                            ', '.join(missing)))
+        tournament, standings = tournaments.create(user_keys, names,
+                                                   request.format)
+        return tournament.to_form(standings)
+
+    @endpoints.method(request_message=GET_TOURNAMENT_REQUEST,
+                      response_message=TournamentForm,
+                      path='tournament/{urlsafe_tournament_key}',
+                      name='get_tournament',
+                      http_method='GET')
+    @profiling.timed()
+    def get_tournament(self, request):
+        """Get the standings of a tournament."""
+        tournament = get_by_urlsafe(request.urlsafe_tournament_key,
+                                    Tournament)
+        if not tournament:
+            raise endpoints.NotFoundException('Tournament not found!')
+        return tournament.to_form(
+                [standing for standing in tournament.standings() if standing])
 
-api = endpoints.api_server([TicTacToeApi])
+api = profiling.ProfilingMiddleware(endpoints.api_server([TicTacToeApi]))
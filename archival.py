@@ -0,0 +1,96 @@
+"""archival.py - Moves finished games out of the Game kind.
+
+A daily cron job starts a chain of tasks that walks the games finished more
+than settings.RETENTION_DAYS ago, BATCH_SIZE per task. Each game is archived
+in its own cross-group transaction, which replaces the Game with one
+unindexed ArchivedGame of the same id that also holds its history; the
+MoveRecord history is then deleted in chunks outside the transaction. The
+games of a batch are archived concurrently as tasklets, and a game that
+fails is logged without holding up the rest. get_game, get_game_history and
+the export fall back to the ArchivedGame, so the Game kind and its indexes
+only grow with live and recently finished games. The UserGame rows stay, as
+they hold the scores. Nothing is archived until the unpickle_histories
+migration (see migrations.py) is done, as the archive is built from the
+MoveRecords alone and a pickled history would be lost with its Game."""
+
+import logging
+from datetime import date, timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import etags
+import settings
+from models import ArchivedGame, Game, Migration, MoveRecord, \
+    UNPICKLE_HISTORIES
+
+ARCHIVE_URL = '/tasks/archive_games'
+BATCH_SIZE = 50
+DELETE_CHUNK = 200
+
+
+def start():
+    """Starts archiving the games older than the retention period"""
+    taskqueue.add(url=ARCHIVE_URL)
+
+
+@ndb.transactional_tasklet(xg=True)
+def _replace_async(game_key, archived):
+    """Replaces a finished game with its ArchivedGame. Returns a future of
+    whether the game was replaced."""
+    game = yield game_key.get_async()
+    if (not game or not game.game_over or game.version != archived.version
+            or 'history' in game._properties):
+        raise ndb.Return(False)
+    yield archived.put_async(), game_key.delete_async()
+    raise ndb.Return(True)
+
+
+@ndb.tasklet
+def _archive_async(game_key):
+    """Archives a finished game and then deletes its history, DELETE_CHUNK
+    records per call. Only replacing the Game is transactional, so a long
+    history does not make the transaction too large. Returns a future of
+    whether the game was archived."""
+    game, records = yield (game_key.get_async(),
+                           MoveRecord.query(ancestor=game_key).fetch_async())
+    if not game or not game.game_over:
+        raise ndb.Return(False)
+    replaced = yield _replace_async(game_key,
+                                    ArchivedGame.from_game(game, records))
+    if not replaced:
+        raise ndb.Return(False)
+    keys = [record.key for record in records]
+    for start in range(0, len(keys), DELETE_CHUNK):
+        yield ndb.delete_multi_async(keys[start:start + DELETE_CHUNK])
+    raise ndb.Return(True)
+
+
+def archive_batch(urlsafe_cursor=None):
+    """Archives the next batch of games finished before the retention
+    period and queues the task of the batch after it. A game that fails is
+    logged and skipped. Returns the number of games archived."""
+    if not Migration.is_done(UNPICKLE_HISTORIES):
+        logging.info('Archival waits for the %s migration',
+                     UNPICKLE_HISTORIES)
+        return 0
+    cutoff = date.today() - timedelta(days=settings.RETENTION_DAYS)
+    keys, cursor, more = Game.query(
+            Game.game_over == True, Game.game_end_date < cutoff).fetch_page(
+            BATCH_SIZE, keys_only=True,
+            start_cursor=Cursor(urlsafe=urlsafe_cursor) if urlsafe_cursor
+            else None)
+    futures = [_archive_async(key) for key in keys]
+    archived = []
+    for key, future in zip(keys, futures):
+        try:
+            if future.get_result():
+                archived.append(key)
+        except Exception:
+            logging.exception('Could not archive game %s', key.urlsafe())
+    if more and cursor:
+        taskqueue.add(url=ARCHIVE_URL, params={'cursor': cursor.urlsafe()})
+    # History pages of archived games take offset cursors, not query ones
+    etags.bump([etags.history(key.urlsafe()) for key in archived])
+    return len(archived)
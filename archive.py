@@ -0,0 +1,79 @@
+"""archive.py - Columnar archive format of finished games.
+
+An archive is a header followed by any number of blocks, each holding a
+batch of games column by column. All values are little endian. A block is
+its game count and moves length (two uint32), then one array per column of
+COLUMNS, then the moves of all its games as one uint8 array: the cells
+played by each game in order, moves_count of them per game. Blocks are
+self-contained, so an interrupted export is resumed by appending blocks.
+
+This module only uses the standard library, so archives can be read
+outside App Engine (see analytics.py)."""
+
+import struct
+
+MAGIC = b'TTTA'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sH')
+BLOCK_HEADER = struct.Struct('<II')
+
+# Result codes
+RESULT_DRAW = 0
+RESULT_X_WINS = 1
+RESULT_O_WINS = 2
+RESULT_UNKNOWN = 255
+
+NO_BOARD = -1  # Board of a game too large for a 64 bit integer
+NO_USER = 0  # Id of a user without an integer id, such as the computer
+NO_DATE = -1
+
+# Column name and struct format code, in block order
+COLUMNS = (
+    ('game_id', 'q'),
+    ('x_user', 'q'),
+    ('o_user', 'q'),
+    ('end_day', 'i'),  # Days since 1970-01-01
+    ('board', 'q'),  # Packed board, see engine.py
+    ('board_size', 'B'),
+    ('win_length', 'B'),
+    ('result', 'B'),
+    ('moves_count', 'H'),
+)
+
+
+def header():
+    """Returns the header of an archive"""
+    return HEADER.pack(MAGIC, FORMAT_VERSION)
+
+
+def read_header(archive_file):
+    """Reads and checks the header of an archive"""
+    magic, version = HEADER.unpack(archive_file.read(HEADER.size))
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError('Not a version %d game archive' % FORMAT_VERSION)
+
+
+def encode_block(rows, moves):
+    """Returns a block of games. rows holds a tuple of the COLUMNS values of
+    each game and moves the bytes of their moves, concatenated."""
+    count = len(rows)
+    parts = [BLOCK_HEADER.pack(count, len(moves))]
+    for index, (name, code) in enumerate(COLUMNS):
+        parts.append(struct.pack('<%d%s' % (count, code),
+                                 *[row[index] for row in rows]))
+    parts.append(moves)
+    return b''.join(parts)
+
+
+def read_blocks(archive_file):
+    """Yields the (count, columns, moves) of each block of an archive read
+    past its header, where columns maps column names to their raw bytes"""
+    while True:
+        data = archive_file.read(BLOCK_HEADER.size)
+        if not data:
+            return
+        count, moves_length = BLOCK_HEADER.unpack(data)
+        columns = {}
+        for name, code in COLUMNS:
+            columns[name] = archive_file.read(count * struct.calcsize(code))
+        yield count, columns, archive_file.read(moves_length)
@@ -0,0 +1,75 @@
+"""audit.py - Buffers the history records (MoveRecord) of rejected moves.
+
+A rejected move does not change the game, so it is not worth a datastore
+write of its own. Its record is kept in instance memory until the game is
+next committed by an accepted move, or until the buffer fills up and every
+pending record is handed to a deferred task that writes them with one
+put_multi, so the request that fills the buffer does not wait for the
+write. The records drained by a commit that fails are buffered again.
+Records still buffered when an instance shuts down are lost; they are an
+audit trail, not game state."""
+
+import threading
+
+from google.appengine.ext import deferred, ndb
+
+import etags
+
+FLUSH_THRESHOLD = 50
+
+_lock = threading.Lock()
+_pending = {}
+_size = [0]
+
+
+def record(game_key, move_record):
+    """Buffers the history record of a rejected move of a game"""
+    restore(game_key, [move_record])
+
+
+def restore(game_key, records):
+    """Buffers records of a game again, ahead of any buffered since, such
+    as the records drained by a commit that failed"""
+    if not records:
+        return
+    with _lock:
+        _pending.setdefault(game_key, [])[:0] = records
+        _size[0] += len(records)
+        full = _size[0] >= FLUSH_THRESHOLD
+    if full:
+        records, game_keys = _take_all()
+        if records:
+            deferred.defer(write, records, game_keys)
+
+
+def drain(game_key):
+    """Removes and returns the buffered records of a game"""
+    with _lock:
+        records = _pending.pop(game_key, [])
+        _size[0] -= len(records)
+    return records
+
+
+def _take_all():
+    """Removes and returns every buffered record and the keys of their
+    games"""
+    with _lock:
+        records = [record for game_records in _pending.values()
+                   for record in game_records]
+        game_keys = _pending.keys()
+        _pending.clear()
+        _size[0] = 0
+    return records, game_keys
+
+
+def flush():
+    """Writes every buffered record"""
+    write(*_take_all())
+
+
+def write(records, game_keys):
+    """Writes records of the games of game_keys"""
+    ndb.put_multi(records)
+    if game_keys:
+        etags.bump([etags.history(game_key.urlsafe())
+                    for game_key in game_keys])
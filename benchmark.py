@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Load test of TicTacToeApi and main.app against the App
+Engine testbed stubs.
+
+Runs scripted workloads (instance warmup, user creation, many interleaved
+games played to the end, long polls, tournaments, score and ranking reads,
+stale moves, the cron, task queue and deferred task handlers, migrations,
+archival and the export) one request at a time, and reports for every
+endpoint and handler
+its p50/p99 latency, datastore RPCs, entities read and written and memcache
+hit ratio as JSON. Datastore and memcache traffic is counted by apiproxy
+hooks, so it includes ndb's own memcache lookups. Usage:
+
+    python benchmark.py --sdk ~/google_appengine [--games 1000] [--output f]
+"""
+
+import argparse
+import base64
+import json
+import math
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MAX_MOVE_FAILURES = 3  # Failed moves in a row before a game is given up
+DEFERRED_URL = '/_ah/queue/deferred'
+TOURNAMENT_PLAYERS = 8
+# Rounds of tournament play before games still active, such as bracket
+# games replayed after draws or given up on failed moves, are left
+MAX_TOURNAMENT_ROUNDS = 20
+WAIT_TIMEOUTS = 3  # Long polls that wait out a one second timeout
+
+
+class EndpointStats(object):
+    """Measurements of one endpoint or handler"""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.datastore_rpcs = 0
+        self.entities_read = 0
+        self.entities_written = 0
+        self.memcache_gets = 0
+        self.memcache_hits = 0
+
+    def report(self):
+        """Returns the stats as a JSON serializable dict"""
+        calls = len(self.latencies)
+        return {
+            'calls': calls,
+            'errors': self.errors,
+            'p50_ms': _percentile(self.latencies, 0.50),
+            'p99_ms': _percentile(self.latencies, 0.99),
+            'datastore_rpcs': self.datastore_rpcs,
+            'datastore_rpcs_per_call': _ratio(self.datastore_rpcs, calls),
+            'entities_read': self.entities_read,
+            'entities_written': self.entities_written,
+            'memcache_gets': self.memcache_gets,
+            'memcache_hit_ratio': _ratio(self.memcache_hits,
+                                         self.memcache_gets),
+        }
+
+
+def _percentile(samples, fraction):
+    """Returns the nearest rank percentile of samples, in milliseconds"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = max(0, int(math.ceil(fraction * len(ordered))) - 1)
+    return round(ordered[index] * 1000, 3)
+
+
+def _ratio(part, whole):
+    return round(float(part) / whole, 4) if whole else None
+
+
+class Benchmark(object):
+    """Drives the workloads and collects the stats of every request"""
+
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.stats = {}
+        self.current = None
+        self.user_names = []
+        self.games = []
+
+    def setup(self):
+        """Activates the testbed stubs and imports the app"""
+        from google.appengine.api import apiproxy_stub_map
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='tic-tac-toe-143303')
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+                probability=1)
+        self.testbed.init_datastore_v3_stub(
+                consistency_policy=policy,
+                require_indexes=self.options.require_indexes,
+                root_path=ROOT)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.taskqueue_stub = self.testbed.get_stub(
+                testbed.TASKQUEUE_SERVICE_NAME)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+                'benchmark', self._count_rpc)
+
+        global api, audit, deferred, main, ndb, endpoints, settings
+        import endpoints
+        from google.appengine.ext import deferred, ndb
+        import api
+        import audit
+        import main
+        import settings
+        self.service = api.TicTacToeApi()
+
+    def teardown(self):
+        self.testbed.deactivate()
+
+    def _count_rpc(self, service, call, request, response):
+        """apiproxy post call hook"""
+        stats = self.stats.get(self.current)
+        if stats is None:
+            return
+        if service == 'datastore_v3':
+            stats.datastore_rpcs += 1
+            if call == 'Get':
+                stats.entities_read += sum(
+                        1 for index in range(response.entity_size())
+                        if response.entity(index).has_entity())
+            elif call in ('RunQuery', 'Next'):
+                stats.entities_read += response.result_size()
+            elif call == 'Put':
+                stats.entities_written += request.entity_size()
+            elif call == 'Delete':
+                stats.entities_written += request.key_size()
+        elif service == 'memcache' and call == 'Get':
+            stats.memcache_gets += request.key_size()
+            stats.memcache_hits += response.item_size()
+
+    def _measure(self, name, function, *args):
+        """Times one request. Returns its result, or None if it failed."""
+        stats = self.stats.setdefault(name, EndpointStats())
+        ndb.get_context().clear_cache()  # Every request starts a new context
+        self.current = name
+        start = time.time()
+        try:
+            return function(*args)
+        except endpoints.ServiceException:
+            stats.errors += 1
+            return None
+        finally:
+            stats.latencies.append(time.time() - start)
+            self.current = None
+
+    def call(self, method, name=None, **fields):
+        """Calls an endpoint method of TicTacToeApi"""
+        endpoint = getattr(self.service, method)
+        request_type = endpoint.remote.request_type
+        return self._measure(name or method, endpoint, request_type(**fields))
+
+    def get(self, url, name=None, headers=None):
+        """Calls a main.app handler with GET"""
+        return self._measure(name or url, self._handle, url, 'GET', '',
+                             headers or {})
+
+    def post(self, url, body='', headers=None, name=None):
+        """Calls a main.app handler, or the deferred task handler, with
+        POST"""
+        return self._measure(name or url, self._handle, url, 'POST', body,
+                             headers or {})
+
+    def _handle(self, url, method, body, headers):
+        import webapp2
+        request = webapp2.Request.blank(url, method=method, body=body,
+                                        headers=headers)
+        app = deferred.application if url == DEFERRED_URL else main.app
+        response = request.get_response(app)
+        if response.status_int >= 400:
+            raise endpoints.InternalServerErrorException(response.status)
+        return response
+
+    def run_tasks(self):
+        """Runs queued tasks, and the tasks they add, until none are left"""
+        while True:
+            tasks = self.taskqueue_stub.GetTasks('default')
+            if not tasks:
+                return
+            for task in tasks:
+                self.taskqueue_stub.DeleteTask('default', task['name'])
+                headers = dict(task['headers'])
+                # The deferred handler only runs requests from the queue
+                headers.setdefault('X-AppEngine-TaskName', task['name'])
+                self.post(task['url'], base64.b64decode(task['body']),
+                          headers, name=task['url'].split('?')[0])
+
+    def create_users(self):
+        for index in range(self.options.users):
+            name = 'user%05d' % index
+            self.call('create_user', user_name=name,
+                      email='%s@example.com' % name)
+            self.user_names.append(name)
+
+    def new_games(self):
+        for index in range(self.options.games):
+            if self.random.random() < self.options.computer_share:
+                name = self.random.choice(self.user_names)
+                seat = self.random.choice(('x_user_name', 'o_user_name'))
+                fields = {seat: name, 'ai_level': self.random.choice(
+                        ('easy', 'medium', 'perfect'))}
+            else:
+                x_name, o_name = self.random.sample(self.user_names, 2)
+                fields = {'x_user_name': x_name, 'o_user_name': o_name,
+                          'board_size': self.options.board_size}
+            form = self.call('new_game', **fields)
+            if form:
+                self.games.append(form)
+
+    def warm_up(self):
+        """Warms up the instance, as App Engine does before routing user
+        requests to it"""
+        self.get('/_ah/warmup')
+
+    def play_games(self, forms=None):
+        """Plays every game, or the given ones, to the end, one move per
+        game per round, so the games are interleaved the way concurrent
+        players would be. A game whose moves fail MAX_MOVE_FAILURES times
+        in a row is given up."""
+        active = list(self.games if forms is None else forms)
+        stale_every = self.options.stale_every
+        moves = 0
+        failures = dict((form.urlsafe_key, 0) for form in active)
+        while active:
+            still_active = []
+            for form in active:
+                if form.game_over:
+                    continue
+                if moves and stale_every and moves % stale_every == 0:
+                    # The move of a client that has not seen the last move
+                    self._move(form, form.version - 1, 'make_move (stale)')
+                moves += 1
+                new_form = self._move(form, form.version, 'make_move')
+                if new_form:
+                    form = new_form
+                    failures[form.urlsafe_key] = 0
+                else:
+                    failures[form.urlsafe_key] += 1
+                if (not form.game_over and
+                        failures[form.urlsafe_key] < MAX_MOVE_FAILURES):
+                    still_active.append(form)
+            active = still_active
+
+    def _move(self, form, version, name):
+        free = [cell for cell, mark in enumerate(form.game_moves)
+                if mark == 'B']
+        user_name = (form.x_user_name if form.moves_count % 2 == 0 else
+                     form.o_user_name)
+        return self.call('make_move', name=name,
+                         urlsafe_game_key=form.urlsafe_key,
+                         user_name=user_name,
+                         move=self.random.choice(free),
+                         expected_version=version)
+
+    def wait_for_moves(self):
+        """Long polls games: the played games have moves since the forms
+        new_game returned and return at once, a few new games wait out
+        their timeout"""
+        for index in range(self.options.waits):
+            form = self.random.choice(self.games)
+            self.call('wait_for_move', urlsafe_game_key=form.urlsafe_key,
+                      moves_count=form.moves_count, timeout=1)
+        for index in range(WAIT_TIMEOUTS):
+            x_name, o_name = self.random.sample(self.user_names, 2)
+            form = self.call('new_game', x_user_name=x_name,
+                             o_user_name=o_name)
+            if form:
+                self.call('wait_for_move', name='wait_for_move (timeout)',
+                          urlsafe_game_key=form.urlsafe_key,
+                          moves_count=form.moves_count, timeout=1)
+
+    def play_tournaments(self):
+        """Creates a round robin and a bracket tournament between players of
+        their own, plays their games round by round, advancing the bracket
+        by its tasks, and reads the standings"""
+        names = []
+        for index in range(TOURNAMENT_PLAYERS):
+            name = 'player%03d' % index
+            self.call('create_user', user_name=name,
+                      email='%s@example.com' % name)
+            names.append(name)
+        tournaments = [self.call('create_tournament', format=tournament_format,
+                                 user_names=names)
+                       for tournament_format in ('round_robin', 'bracket')]
+        for index in range(MAX_TOURNAMENT_ROUNDS):
+            keys = set()
+            for name in names:
+                page = self.call('get_user_games', user_name=name,
+                                 limit=100)
+                keys.update(item.game_key for item in
+                            (page.items if page else []) if not item.game_over)
+            forms = [self.call('get_game', urlsafe_game_key=key)
+                     for key in sorted(keys)]
+            forms = [form for form in forms if form and not form.game_over]
+            if not forms:
+                break
+            self.play_games(forms)
+            self.run_tasks()
+        for form in tournaments:
+            if form:
+                self.call('get_tournament',
+                          urlsafe_tournament_key=form.urlsafe_key)
+
+    def read_results(self):
+        for index in range(self.options.reads):
+            name = self.random.choice(self.user_names)
+            form = self.random.choice(self.games)
+            self.call('get_game', urlsafe_game_key=form.urlsafe_key)
+            self.call('get_game_history', urlsafe_game_key=form.urlsafe_key)
+            self.call('get_scores')
+            self.call('get_user_scores', user_name=name)
+            self.call('get_user_games', user_name=name)
+            self.call('get_user_rankings')
+            self.call('get_user_rank', user_name=name)
+            self.call('get_average_moves')
+
+    def cancel_games(self):
+        """Starts and cancels a few games"""
+        for index in range(self.options.cancels):
+            x_name, o_name = self.random.sample(self.user_names, 2)
+            form = self.call('new_game', x_user_name=x_name,
+                             o_user_name=o_name)
+            if form:
+                self.call('cancel_game', urlsafe_game_key=form.urlsafe_key)
+
+    def run_cron(self):
+        """Runs the cron and admin handlers with some games still active"""
+        for index in range(self.options.games // 10 or 1):
+            x_name, o_name = self.random.sample(self.user_names, 2)
+            self.call('new_game', x_user_name=x_name, o_user_name=o_name)
+        self.get('/crons/send_reminder')
+        self.run_tasks()
+        self.post('/tasks/cache_average_moves')
+        self.post('/tasks/rebuild_leaderboard')
+        self.run_tasks()
+        self.get('/crons/migrate')
+        self.run_tasks()
+
+    def archive_and_export(self):
+        """Archives the finished games older than --retention-days, then
+        exports the finished games, following the export cursor"""
+        settings.RETENTION_DAYS = self.options.retention_days
+        self.get('/crons/archive_games')
+        self.run_tasks()
+        response = self.get('/admin/export_games')
+        while response and 'X-Next-Cursor' in response.headers:
+            response = self.get('/admin/export_games?cursor=' +
+                                response.headers['X-Next-Cursor'])
+
+    def run(self):
+        """Runs every workload. Returns the JSON serializable report."""
+        started = time.time()
+        self.warm_up()
+        self.create_users()
+        self.new_games()
+        self.play_games()
+        self.run_tasks()
+        audit.flush()
+        self.wait_for_moves()
+        self.play_tournaments()
+        self.read_results()
+        self.cancel_games()
+        self.run_cron()
+        self.archive_and_export()
+        return {
+            'options': vars(self.options),
+            'seconds': round(time.time() - started, 3),
+            'endpoints': dict((name, stats.report())
+                              for name, stats in sorted(self.stats.items())),
+        }
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='Path of the App Engine Python SDK')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--board-size', type=int, default=3)
+    parser.add_argument('--computer-share', type=float, default=0.1,
+                        help='Share of the games played against the computer')
+    parser.add_argument('--stale-every', type=int, default=50,
+                        help='Send a stale move every this many moves')
+    parser.add_argument('--reads', type=int, default=200)
+    parser.add_argument('--waits', type=int, default=50,
+                        help='Long polls of games with an unseen move')
+    parser.add_argument('--cancels', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--retention-days', type=int, default=-1,
+                        help='Archive the games finished more than this '
+                        'many days ago; -1 archives every finished game')
+    parser.add_argument('--require-indexes', action='store_true',
+                        help='Fail queries missing from index.yaml')
+    parser.add_argument('--output', help='Write the report to a file')
+    return parser.parse_args()
+
+
+def _main():
+    options = _parse_args()
+    if options.sdk:
+        sys.path.insert(0, options.sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+    benchmark = Benchmark(options)
+    benchmark.setup()
+    try:
+        report = benchmark.run()
+    finally:
+        benchmark.teardown()
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as report_file:
+            report_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,115 @@
+"""counters.py - Sharded counters.
+
+Each counter is split into NUM_SHARDS entities and an increment updates one
+of them, picked at random, in a small transaction, so frequent updates do
+not contend on a single entity. A caller that already writes in a
+transaction can add its shard updates to its own put instead (see
+add_to_shards). The total is served from memcache, which increments keep
+current; on a miss it is summed from the shards with one get_multi and
+cached for TOTAL_TTL seconds, so an increment that lands between the sum
+and the add is only missed until then."""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+NUM_SHARDS = 20
+MEMCACHE_COUNTER = 'COUNTER:%s'
+TOTAL_TTL = 60
+
+
+class CounterShard(ndb.Model):
+    """One shard of a counter. Keyed by counter name and shard number."""
+    count = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+def _shard_keys(name):
+    return [ndb.Key(CounterShard, '%s:%d' % (name, shard))
+            for shard in range(NUM_SHARDS)]
+
+
+def _random_shard_key(name):
+    return _shard_keys(name)[random.randint(0, NUM_SHARDS - 1)]
+
+
+@ndb.transactional_tasklet
+def _increment_shard_async(key, delta):
+    shard = yield key.get_async()
+    if not shard:
+        shard = CounterShard(key=key)
+    shard.count += delta
+    yield shard.put_async()
+
+
+def increment(deltas):
+    """Adds to counters. deltas is a dict of counter name to delta."""
+    futures = [_increment_shard_async(_random_shard_key(name), delta)
+               for name, delta in deltas.items() if delta]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+    add_to_totals(deltas)
+
+
+def add_to_shards(deltas):
+    """Returns a random shard of each counter with its delta added, unsaved,
+    for a caller that saves them in its own cross-group transaction along
+    with its other entities. The caller calls add_to_totals(deltas) once
+    the transaction commits."""
+    names = [name for name, delta in deltas.items() if delta]
+    keys = [_random_shard_key(name) for name in names]
+    shards = ndb.get_multi(keys)
+    for index, name in enumerate(names):
+        if not shards[index]:
+            shards[index] = CounterShard(key=keys[index])
+        shards[index].count += deltas[name]
+    return shards
+
+
+def add_to_totals(deltas):
+    """Adds to the cached totals of counters whose shards were updated"""
+    for name, delta in deltas.items():
+        if delta > 0:
+            memcache.incr(MEMCACHE_COUNTER % name, delta)
+        elif delta < 0:
+            memcache.decr(MEMCACHE_COUNTER % name, -delta)
+
+
+def get_counts(names):
+    """Returns a dict of counter name to total"""
+    cached = memcache.get_multi(names, key_prefix=MEMCACHE_COUNTER % '')
+    missing = [name for name in names if name not in cached]
+    if missing:
+        shards = ndb.get_multi([key for name in missing
+                                for key in _shard_keys(name)])
+        for index, name in enumerate(missing):
+            cached[name] = sum(shard.count for shard in
+                               shards[index * NUM_SHARDS:
+                                      (index + 1) * NUM_SHARDS]
+                               if shard)
+            memcache.add(MEMCACHE_COUNTER % name, cached[name], TOTAL_TTL)
+    return cached
+
+
+def reset(counts):
+    """Moves counters to the given totals. counts is a dict of counter name
+    to total. The difference from the current total is added to a shard,
+    so increments made while the totals were counted are kept rather than
+    overwritten; an increment for a game the count already included is
+    counted twice, until the next reset."""
+    names = list(counts)
+    shards = ndb.get_multi([key for name in names
+                            for key in _shard_keys(name)])
+    deltas = {}
+    for index, name in enumerate(names):
+        current = sum(shard.count for shard in
+                      shards[index * NUM_SHARDS:(index + 1) * NUM_SHARDS]
+                      if shard)
+        deltas[name] = counts[name] - current
+    futures = [_increment_shard_async(_shard_keys(name)[0], delta)
+               for name, delta in deltas.items() if delta]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+    memcache.delete_multi(names, key_prefix=MEMCACHE_COUNTER % '')
@@ -0,0 +1,189 @@
+"""engine.py - Bitboard game engine for tic-tac-toe.
+
+A board is packed into a single integer: the low 9 bits are the cells taken
+by X and the next 9 bits the cells taken by O (bit i is cell i, numbered 0 to
+8 from the top left). The outcome of every one of the 3^9 cell encodings is
+computed once at import, so win, draw and legal move checks are table
+lookups.
+
+Larger size x size boards with a win_length in a row rule are packed the
+same way, with size * size bits per player. Their outcome is found by
+outcome_after, which only walks the lines through the last move."""
+
+import binascii
+
+X = 0
+O = 1
+MARKS = ('X', 'O')
+BLANK = 'B'
+
+SIZE = 9
+FULL = (1 << SIZE) - 1
+EMPTY = 0
+
+BOARD_SIZE = 3
+WIN_LENGTH = 3
+MAX_BOARD_SIZE = 15  # Cells of the largest board still fit in a byte
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+IN_PROGRESS = 0
+X_WINS = 1
+O_WINS = 2
+DRAW = 3
+
+WIN_LINES = (0x007, 0x038, 0x1C0,  # rows
+             0x049, 0x092, 0x124,  # columns
+             0x111, 0x054)         # diagonals
+
+
+def _ternary(bits):
+    """Returns the base 3 value of bits with every set bit counted as 1"""
+    value = 0
+    for cell in range(SIZE - 1, -1, -1):
+        value = value * 3 + ((bits >> cell) & 1)
+    return value
+
+
+def _has_line(bits):
+    for line in WIN_LINES:
+        if bits & line == line:
+            return True
+    return False
+
+
+def _build_outcomes():
+    """Computes the outcome of every base 3 cell encoding"""
+    outcomes = bytearray(3 ** SIZE)
+    for code in range(3 ** SIZE):
+        x_bits = o_bits = 0
+        value = code
+        for cell in range(SIZE):
+            value, digit = divmod(value, 3)
+            if digit == 1:
+                x_bits |= 1 << cell
+            elif digit == 2:
+                o_bits |= 1 << cell
+        if _has_line(x_bits):
+            outcomes[code] = X_WINS
+        elif _has_line(o_bits):
+            outcomes[code] = O_WINS
+        elif x_bits | o_bits == FULL:
+            outcomes[code] = DRAW
+    return outcomes
+
+
+def _build_moves():
+    """Lists the cells of every 9 bit free mask"""
+    return [tuple(cell for cell in range(SIZE) if (mask >> cell) & 1)
+            for mask in range(1 << SIZE)]
+
+
+_TERNARY = [_ternary(bits) for bits in range(1 << SIZE)]
+_OUTCOMES = _build_outcomes()
+_MOVES = _build_moves()
+
+
+def pack(x_bits, o_bits):
+    """Returns the board holding the given X and O cells"""
+    return x_bits | (o_bits << SIZE)
+
+
+def unpack(board):
+    """Returns the (x_bits, o_bits) pair of a board"""
+    return board & FULL, board >> SIZE
+
+
+def encode(board):
+    """Returns the base 3 encoding of a board (0 blank, 1 X, 2 O per cell)"""
+    return _TERNARY[board & FULL] + 2 * _TERNARY[board >> SIZE]
+
+
+def outcome(board):
+    """Returns IN_PROGRESS, X_WINS, O_WINS or DRAW"""
+    return _OUTCOMES[_TERNARY[board & FULL] + 2 * _TERNARY[board >> SIZE]]
+
+
+def free_cells(board):
+    """Returns the bit mask of the cells still available"""
+    return ~(board | (board >> SIZE)) & FULL
+
+
+def legal_moves(board):
+    """Returns the tuple of cells still available"""
+    return _MOVES[free_cells(board)]
+
+
+def is_cell(cell, size=BOARD_SIZE):
+    """Checks that cell is on the board"""
+    return 0 <= cell < size * size
+
+
+def is_free(board, cell, size=BOARD_SIZE):
+    """Checks that cell is on the board and not taken"""
+    cells = size * size
+    return (0 <= cell < cells and not (board >> cell) & 1 and
+            not (board >> (cell + cells)) & 1)
+
+
+def place(board, cell, player, size=BOARD_SIZE):
+    """Returns the board after player (X or O) takes cell"""
+    return board | (1 << (cell + size * size * player))
+
+
+def outcome_after(board, cell, size=BOARD_SIZE, win_length=WIN_LENGTH):
+    """Returns the outcome of a board just after a move on cell. Only the
+    win_length cells on either side of cell along each line through it are
+    examined."""
+    if size == BOARD_SIZE and win_length == WIN_LENGTH:
+        return outcome(board)
+    cells = size * size
+    player = X if (board >> cell) & 1 else O
+    bits = board >> (cells * player)
+    row, col = divmod(cell, size)
+    for row_step, col_step in DIRECTIONS:
+        run = 1
+        for sign in (1, -1):
+            r, c = row + sign * row_step, col + sign * col_step
+            while (run < win_length and 0 <= r < size and 0 <= c < size and
+                   (bits >> (r * size + c)) & 1):
+                run += 1
+                r, c = r + sign * row_step, c + sign * col_step
+        if run >= win_length:
+            return X_WINS if player == X else O_WINS
+    full = (1 << cells) - 1
+    if (board | (board >> cells)) & full == full:
+        return DRAW
+    return IN_PROGRESS
+
+
+def to_cells(board, size=BOARD_SIZE):
+    """Returns the board as a list of 'X', 'O' and 'B' strings"""
+    cells = size * size
+    return ['X' if (board >> cell) & 1 else
+            'O' if (board >> (cell + cells)) & 1 else BLANK
+            for cell in range(cells)]
+
+
+def fits_integer(size):
+    """Checks that boards of a size fit a 64 bit datastore integer"""
+    return 2 * size * size < 64
+
+
+def to_bytes(board):
+    """Returns a board as a big endian byte string"""
+    digits = '%x' % board
+    return binascii.unhexlify('0' * (len(digits) % 2) + digits)
+
+
+def from_bytes(data):
+    """Returns the board of a byte string made by to_bytes"""
+    return int(binascii.hexlify(data), 16) if data else EMPTY
+
+
+def from_cells(cells):
+    """Returns the board of a list of 'X', 'O' and 'B' strings"""
+    board = EMPTY
+    for cell, mark in enumerate(cells):
+        if mark in MARKS:
+            board = place(board, cell, MARKS.index(mark))
+    return board
@@ -0,0 +1,53 @@
+"""etags.py - Versions behind conditional reads.
+
+A read endpoint returns an etag with its response. A client that sends the
+etag back gets a small not_modified response while it is still current,
+without the server building the forms. Game etags come from the game's
+version. History, scores and ranking etags come from version counters kept
+in memcache and bumped by every write that changes them. A counter that was
+evicted restarts from the current time in milliseconds, so it does not
+repeat a value an earlier client saw."""
+
+import hashlib
+import time
+
+from google.appengine.api import memcache
+
+MEMCACHE_VERSION = 'VERSION:%s'
+LEADERBOARD = 'leaderboard'
+SCORES = 'scores'
+
+
+def history(urlsafe_game_key):
+    """Returns the name of the version counter of a game's history"""
+    return 'history:' + urlsafe_game_key
+
+
+def _now():
+    return int(time.time() * 1000)
+
+
+def versions(names):
+    """Returns a dict of version counter name to version"""
+    prefix = MEMCACHE_VERSION % ''
+    found = memcache.get_multi(names, key_prefix=prefix)
+    missing = [name for name in names if name not in found]
+    if missing:
+        memcache.add_multi(dict((name, _now()) for name in missing),
+                           key_prefix=prefix)
+        found.update(memcache.get_multi(missing, key_prefix=prefix))
+        for name in missing:
+            found.setdefault(name, _now())  # Memcache is unavailable
+    return found
+
+
+def bump(names):
+    """Moves version counters on"""
+    memcache.offset_multi(dict((name, 1) for name in names),
+                          key_prefix=MEMCACHE_VERSION % '',
+                          initial_value=_now())
+
+
+def make(*parts):
+    """Returns the etag of a response that depends on parts"""
+    return hashlib.md5(repr(parts)).hexdigest()[:16]
@@ -0,0 +1,93 @@
+"""export.py - Bulk export of finished games to a columnar archive.
+
+Finished games are read in pages of BATCH_SIZE with query cursors and
+written as one archive block per page (see archive.py), so an export never
+holds more than a page of games in memory. Finished games still in Game come
+first, then the ArchivedGames of the games moved out by archival.py; a game
+archived while an export runs may be exported twice. Games record their
+moves in move_sequence; the moves of older games are read from their
+history, with the history queries of a page run concurrently."""
+
+from datetime import date
+
+from google.appengine.datastore.datastore_query import Cursor
+
+import archive
+import engine
+from models import ArchivedGame, Game, MoveRecord
+
+BATCH_SIZE = 500
+ARCHIVED_CURSOR = 'archived:'  # Prefix of the cursors of archived games
+EPOCH = date(1970, 1, 1).toordinal()
+
+_RESULTS = {
+    engine.DRAW: archive.RESULT_DRAW,
+    engine.X_WINS: archive.RESULT_X_WINS,
+    engine.O_WINS: archive.RESULT_O_WINS,
+}
+
+
+def _user_id(key):
+    user_id = key.id()
+    return user_id if isinstance(user_id, (int, long)) else archive.NO_USER
+
+
+def _row(game, moves):
+    """Returns the archive.COLUMNS values of a finished game"""
+    board = game.current_board()
+    result = _RESULTS.get(game.final_outcome(moves), archive.RESULT_UNKNOWN)
+    if not engine.fits_integer(game.board_size):
+        board = archive.NO_BOARD
+    end_day = archive.NO_DATE
+    if game.game_end_date:
+        end_day = game.game_end_date.toordinal() - EPOCH
+    return (game.key.id(), _user_id(game.x_user), _user_id(game.o_user),
+            end_day, board, game.board_size, game.win_length, result,
+            len(moves))
+
+
+def export_block(games):
+    """Returns the archive block of a page of finished games or
+    ArchivedGames"""
+    histories = dict(
+            (game.key, MoveRecord.query(ancestor=game.key).fetch_async())
+            for game in games
+            if isinstance(game, Game) and not game.move_sequence)
+    rows = []
+    moves = []
+    for game in games:
+        if game.key in histories:
+            game_moves = MoveRecord.accepted_moves(
+                    histories[game.key].get_result())
+        else:
+            game_moves = game.move_sequence or ''
+        rows.append(_row(game, game_moves))
+        moves.append(game_moves)
+    return archive.encode_block(rows, ''.join(moves))
+
+
+def export(urlsafe_cursor=None, batch_size=BATCH_SIZE):
+    """Yields the (block, next_cursor) of each page of finished games, from
+    the cursor of an earlier export if one is given. next_cursor is a
+    string, or None after the last page."""
+    queries = [('', Game.query(Game.game_over == True)),
+               (ARCHIVED_CURSOR, ArchivedGame.query())]
+    if urlsafe_cursor and urlsafe_cursor.startswith(ARCHIVED_CURSOR):
+        queries = queries[1:]
+        urlsafe_cursor = urlsafe_cursor[len(ARCHIVED_CURSOR):]
+    for index, (prefix, query) in enumerate(queries):
+        cursor = Cursor(urlsafe=urlsafe_cursor) if urlsafe_cursor else None
+        urlsafe_cursor = None
+        more = True
+        while more:
+            games, cursor, more = query.fetch_page(batch_size,
+                                                   start_cursor=cursor)
+            more = more and cursor is not None
+            if more:
+                next_cursor = prefix + cursor.urlsafe()
+            elif index + 1 < len(queries):
+                next_cursor = queries[index + 1][0]
+            else:
+                next_cursor = None
+            if games:
+                yield export_block(games), next_cursor
@@ -0,0 +1,101 @@
+"""gamecache.py - Memcache cache of live game state.
+
+The state clients poll for, everything in a GameForm but the message, is
+kept in memcache as one compact GameState per game, so get_game is served by
+a single memcache get. Every committed move writes the new state through
+with compare-and-set, keeping the newest version when moves race. Ending or
+cancelling a game deletes its entry and blocks re-adding it for
+INVALIDATE_LOCK seconds, so a read that loaded the game just before cannot
+put the old state back; the next read after that reloads it from the
+datastore.
+
+Next to the state, a change marker holds the game's moves count, or
+CANCELLED once the game is cancelled. wait_for_move polls only this small
+marker while a player waits for the opponent's move."""
+
+import time
+
+from google.appengine.api import memcache
+
+MEMCACHE_GAME_STATE = 'GAME_STATE:%s'
+MEMCACHE_GAME_MOVES = 'GAME_MOVES:%s'
+STATE_TTL = 60 * 60
+INVALIDATE_LOCK = 5
+CAS_RETRIES = 3
+POLL_INTERVAL = 0.5
+CANCELLED = -1
+
+
+def _cache_key(game_key):
+    return MEMCACHE_GAME_STATE % game_key.urlsafe()
+
+
+def _marker_key(game_key):
+    return MEMCACHE_GAME_MOVES % game_key.urlsafe()
+
+
+def get(urlsafe_game_key):
+    """Returns the cached GameState of a game, or None"""
+    return memcache.get(MEMCACHE_GAME_STATE % urlsafe_game_key)
+
+
+def add(game):
+    """Caches the state and change marker of a game loaded from the
+    datastore, unless they are cached already. Returns the state."""
+    state = game.state()
+    memcache.add_multi({_cache_key(game.key): state,
+                        _marker_key(game.key): state.moves_count},
+                       time=STATE_TTL)
+    return state
+
+
+def update(game):
+    """Writes through the state and change marker of a game after a move,
+    unless a newer version is cached. Returns the state."""
+    state = game.state()
+    client = memcache.Client()
+    cache_key = _cache_key(game.key)
+    for attempt in range(CAS_RETRIES):
+        cached = client.gets(cache_key)
+        if cached is None:
+            if client.add(cache_key, state, STATE_TTL):
+                break
+        elif cached.version >= state.version:
+            return state
+        elif client.cas(cache_key, state, STATE_TTL):
+            break
+    else:
+        client.delete(cache_key)
+    client.set(_marker_key(game.key), state.moves_count, STATE_TTL)
+    return state
+
+
+def invalidate(game_key, marker):
+    """Drops the cached state of a game that ended or was cancelled, and
+    sets its change marker to its final moves count or CANCELLED"""
+    memcache.delete(_cache_key(game_key), seconds=INVALIDATE_LOCK)
+    memcache.set(_marker_key(game_key), marker, STATE_TTL)
+
+
+def seed_marker(urlsafe_game_key, moves_count):
+    """Sets the change marker of a game to moves_count, unless a marker is
+    cached. Used when the marker was evicted but the state was not."""
+    memcache.add(MEMCACHE_GAME_MOVES % urlsafe_game_key, moves_count,
+                 STATE_TTL)
+
+
+def wait_for_move(urlsafe_game_key, moves_count, deadline):
+    """Polls the change marker of a game every POLL_INTERVAL seconds until
+    it differs from moves_count or the deadline (a time.time() value)
+    passes. Returns True if it changed, False on timeout and None if no
+    marker is cached."""
+    marker_key = MEMCACHE_GAME_MOVES % urlsafe_game_key
+    while True:
+        marker = memcache.get(marker_key)
+        if marker is None:
+            return None
+        if marker != moves_count:
+            return True
+        if time.time() + POLL_INTERVAL > deadline:
+            return False
+        time.sleep(POLL_INTERVAL)
@@ -0,0 +1,235 @@
+"""leaderboard.py - Incrementally maintained user ranking.
+
+Users are ordered by winning percentage rate (descending), number of wins
+(descending) and average game moves on winning games (ascending). The three
+are packed into one integer, the rank score, so that a higher score is a
+better ranking.
+
+The number of users at every score is kept in a radix tree of RankNode
+entities: each node covers a range of scores and counts the users in each
+of its BRANCHES sub-ranges. The rank of a score is one plus the number of
+users counted to its right on the path from the root to the score, so it
+costs one get_multi of the path's LEVELS nodes, however many users there
+are. Every node is split into NUM_SHARDS entities so concurrent end_game
+calls seldom contend on the same entity.
+
+The tree is rebuilt as a new generation of RankNodes while the live one
+keeps serving (see start_build). Each User records the generation that
+counts it in rank_generation: while a build runs, users are counted into
+the new generation one transaction at a time, and a user whose score moves
+is moved in every generation that counts it. Once every user is counted,
+finish_build makes the new generation live."""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import etags
+
+MEMCACHE_TOP_RANKINGS = 'TOP_RANKINGS'
+TREE_ID = 'tree'
+
+DIGIT_BITS = 8
+BRANCHES = 1 << DIGIT_BITS
+LEVELS = 6
+SCORE_BITS = DIGIT_BITS * LEVELS
+NUM_SHARDS = 4
+
+_FIELD_MAX = 0xFFFF
+
+
+class RankNode(ndb.Model):
+    """One shard of a node of the ranking tree. Keyed by level, score
+    prefix and shard number."""
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+
+
+class RankTree(ndb.Model):
+    """The generation of RankNodes that is live, and the one being built, if
+    any"""
+    live = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    building = ndb.IntegerProperty(indexed=False)
+
+
+def tree():
+    """Returns the RankTree"""
+    return RankTree.get_by_id(TREE_ID) or RankTree(id=TREE_ID)
+
+
+def score(user):
+    """Returns the rank score of a User. The rate is kept to 2 decimals and
+    wins and average moves (to 2 decimals) are capped at 65535."""
+    rate = int(round(user.winning_percentage_rate * 100))
+    wins = min(user.nbr_wins, _FIELD_MAX)
+    moves = min(int(round(user.average_game_moves_on_winning_games * 100)),
+                _FIELD_MAX)
+    return (rate << 32) | (wins << 16) | (_FIELD_MAX - moves)
+
+
+def _path(rank_score):
+    """Returns the (level, prefix, digit) of each node on the path to a
+    score"""
+    path = []
+    for level in range(LEVELS):
+        shift = SCORE_BITS - DIGIT_BITS * (level + 1)
+        path.append((level, rank_score >> (shift + DIGIT_BITS),
+                     (rank_score >> shift) & (BRANCHES - 1)))
+    return path
+
+
+def _shard_key(generation, level, prefix, shard):
+    # Generation 0 keeps the key names of the tree before generations
+    name = '%d:%x:%d' % (level, prefix, shard)
+    if generation:
+        name = 'g%d:%s' % (generation, name)
+    return ndb.Key(RankNode, name)
+
+
+def rank(rank_score):
+    """Returns the 1-based rank of a score in the live tree. Users with the
+    same score share a rank."""
+    generation = tree().live
+    path = _path(rank_score)
+    keys = [_shard_key(generation, level, prefix, shard)
+            for level, prefix, digit in path
+            for shard in range(NUM_SHARDS)]
+    nodes = ndb.get_multi(keys)
+    better = 0
+    for index, (level, prefix, digit) in enumerate(path):
+        for node in nodes[index * NUM_SHARDS:(index + 1) * NUM_SHARDS]:
+            if node:
+                better += sum(node.counts[digit + 1:])
+    return better + 1
+
+
+def counted_generation(user, old_score):
+    """Returns the generation of the tree that counted a User at old_score,
+    or None if no tree counts the user. Users ranked before generations
+    existed have no rank_generation and are counted by generation 0."""
+    if user.rank_generation is not None:
+        return user.rank_generation
+    return None if old_score is None else 0
+
+
+def place(user, old_score, current=None):
+    """Records in rank_generation that a User, whose rank score moved from
+    old_score, is counted by the tree being built, or else the live one.
+    Returns the (generation, old_score, new_score) moves that record()
+    applies: the user is counted at its new score in the live tree and in
+    the tree being built, and only taken out of old_score in the trees that
+    counted it. current is the RankTree, read if not given; a stale one is
+    corrected by the user's own rank_generation."""
+    current = current or tree()
+    live, building = current.live, current.building
+    counted = counted_generation(user, old_score)
+    if counted is not None and counted > live:
+        building = counted  # A build started after current was read
+    in_building = building is not None and counted == building
+    in_live = in_building or counted == live
+    moves = [(live, old_score if in_live else None, user.rank_score)]
+    if building is not None:
+        moves.append((building, old_score if in_building else None,
+                      user.rank_score))
+    user.rank_generation = live if building is None else building
+    return moves
+
+
+def record(moves):
+    """Applies the (generation, old_score, new_score) moves of users, see
+    place(). old_score is None for a user new to a generation. The cached
+    rankings are invalidated even if no score moved, as the stats shown
+    with the rankings changed."""
+    futures = _apply_async(moves)
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+    invalidate()
+
+
+def invalidate():
+    """Drops the cached top rankings and moves the rankings etags on"""
+    memcache.delete(MEMCACHE_TOP_RANKINGS)
+    etags.bump([etags.LEADERBOARD])
+
+
+def _apply_async(moves):
+    """Starts adding the moves to random shards of the nodes. Returns the
+    futures of the node updates."""
+    deltas = {}
+    for generation, old_score, new_score in moves:
+        if old_score == new_score:
+            continue
+        for rank_score, delta in ((old_score, -1), (new_score, 1)):
+            if rank_score is None:
+                continue
+            for level, prefix, digit in _path(rank_score):
+                node = deltas.setdefault((generation, level, prefix), {})
+                node[digit] = node.get(digit, 0) + delta
+    futures = []
+    for (generation, level, prefix), digits in deltas.items():
+        digits = dict((digit, delta) for digit, delta in digits.items()
+                      if delta)
+        if digits:
+            shard = random.randint(0, NUM_SHARDS - 1)
+            futures.append(_update_async(
+                    _shard_key(generation, level, prefix, shard), digits))
+    return futures
+
+
+@ndb.tasklet
+def apply_async(moves):
+    """Returns a future of applying the moves, for callers that apply them
+    in their own transaction. The caller invalidates the cached rankings."""
+    yield _apply_async(moves)
+
+
+@ndb.transactional_tasklet
+def _update_async(key, digits):
+    """Adds deltas to the counts of a node shard"""
+    node = yield key.get_async()
+    if not node:
+        node = RankNode(key=key, counts=[0] * BRANCHES)
+    for digit, delta in digits.items():
+        node.counts[digit] += delta
+    yield node.put_async()
+
+
+@ndb.transactional
+def start_build():
+    """Starts building a new generation of the tree, unless one is being
+    built already. Returns the RankTree."""
+    current = tree()
+    if current.building is None:
+        current.building = current.live + 1
+        current.put()
+    return current
+
+
+@ndb.transactional
+def _switch():
+    """Makes the generation being built live. Returns the generation that
+    was live before, or None if no generation was being built."""
+    current = tree()
+    if current.building is None:
+        return None
+    old_generation = current.live
+    current.live, current.building = current.building, None
+    current.put()
+    return old_generation
+
+
+def finish_build():
+    """Makes the generation being built live, once every user is counted
+    by it, and deletes the nodes of the generation it replaces"""
+    old_generation = _switch()
+    if old_generation is None:
+        return
+    invalidate()
+    # Node names of a generation sort together, generation 0 before 'g'
+    query = RankNode.query(RankNode.key < ndb.Key(RankNode, 'g'))
+    if old_generation:
+        query = RankNode.query(
+                RankNode.key >= ndb.Key(RankNode, 'g%d:' % old_generation),
+                RankNode.key < ndb.Key(RankNode, 'g%d;' % old_generation))
+    ndb.delete_multi(query.fetch(keys_only=True))
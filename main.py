@@ -1,51 +1,145 @@
 #!/usr/bin/env python
 
 """main.py - This file contains handlers that are called by taskqueue and/or
-cronjobs."""
+cronjobs. The API module, the export and tournaments are only imported by
+the handlers that use them, so the other handlers start without loading
+endpoints."""
+import time
+_import_started = time.time()
+
+import json
 import logging
 
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import TicTacToeApi
+from google.appengine.ext import ndb
+
+import archival
+import migrations
+import profiling
+import reminders
+import warmup
+from models import ADVANCE_BRACKET_URL, REBUILD_LEADERBOARD
 
-from models import User, Game
+# Seconds an export request keeps adding blocks before it returns
+EXPORT_SECONDS = 45
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
         """Send a reminder email to Users when it is thier turn to make a move.
-        Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        games = Game.query(Game.game_over == False)
-        for game in games: 
-            if (game.moves_count + 1) % 2 == 0: # o_user is the next move
-                user_to_email = game.o_user
-                opponent_user = game.x_user
-            else: # x_user is the next move     
-                user_to_email = game.x_user
-                opponent_user = game.o_user
-            user = User.query(User.key == user_to_email).get()
-            opponent = User.query(User.key == opponent_user).get()
-            subject = 'This is a reminder!'
-            if game.moves_count == 0:
-                body = 'Hello {}, Make your first move!'.format(user.name) 
-            else:
-                body = 'Hello {}, {} just made move.  It is your turn to win the game!'.format(user.name, opponent.name)
-            # This will send test emails, the arguments to send_mail are:
-            # from, to, subject, body
-            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                           user.email,
-                           subject,
-                           body)
+        Called every hour using a cron job. Starts a reminder run whose
+        batches are processed by CollectReminders and SendReminders."""
+        reminders.start()
+
+
+class CollectReminders(webapp2.RequestHandler):
+    def post(self):
+        """Collect the reminders of the next batch of active games."""
+        reminders.collect_batch(self.request.get('run'))
+
+
+class SendReminders(webapp2.RequestHandler):
+    def post(self):
+        """Mail the next batch of reminder digests."""
+        reminders.send_batch(self.request.get('run'))
+
 
 class UpdateAverageMoves(webapp2.RequestHandler):
     def post(self):
-        """Update game listing announcement in memcache."""
+        """Recount the active game counters from the datastore."""
+        from api import TicTacToeApi
         TicTacToeApi._cache_average_moves()
         self.response.set_status(204)
 
 
-app = webapp2.WSGIApplication([
+class RebuildLeaderboard(webapp2.RequestHandler):
+    def post(self):
+        """Recompute every user's rank score and rebuild the leaderboard as
+        a new tree generation, in deferred batches."""
+        migrations.rerun(REBUILD_LEADERBOARD)
+        self.response.set_status(204)
+
+
+class AdvanceBracket(webapp2.RequestHandler):
+    def post(self):
+        """Move the winner of a bracket tournament game to the next round."""
+        import tournaments
+        winner = self.request.get('winner')
+        tournaments.advance(ndb.Key(urlsafe=self.request.get('game')),
+                            ndb.Key(urlsafe=winner) if winner else None)
+
+
+class ProfileSummary(webapp2.RequestHandler):
+    def get(self):
+        """Serve the rolling summary of the profiled requests of this
+        instance."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(profiling.summary(), indent=2,
+                                       sort_keys=True))
+
+
+class StartMigrations(webapp2.RequestHandler):
+    def get(self):
+        """Start the data migrations that never ran. Called every hour by a
+        cron job."""
+        migrations.start()
+
+
+class ArchiveGames(webapp2.RequestHandler):
+    def get(self):
+        """Start archiving the games finished before the retention period.
+        Called daily by a cron job."""
+        archival.start()
+
+
+class ArchiveBatch(webapp2.RequestHandler):
+    def post(self):
+        """Archive the next batch of old finished games."""
+        archival.archive_batch(self.request.get('cursor') or None)
+
+
+class ExportGames(webapp2.RequestHandler):
+    def get(self):
+        """Serve the finished games as a columnar archive (see archive.py).
+        An export that does not finish in EXPORT_SECONDS returns the cursor
+        to continue from in the X-Next-Cursor header; the blocks returned
+        for that cursor are appended to the same file."""
+        import archive
+        import export
+        cursor = self.request.get('cursor') or None
+        deadline = time.time() + EXPORT_SECONDS
+        self.response.headers['Content-Type'] = 'application/octet-stream'
+        if not cursor:
+            self.response.write(archive.header())
+        next_cursor = None
+        for block, next_cursor in export.export(cursor):
+            self.response.write(block)
+            if time.time() > deadline:
+                break
+        if next_cursor:
+            self.response.headers['X-Next-Cursor'] = str(next_cursor)
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Load the API and prime the shared caches before this new
+        instance serves user requests."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(warmup.warm()))
+
+
+app = profiling.ProfilingMiddleware(webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/crons/archive_games', ArchiveGames),
+    ('/crons/migrate', StartMigrations),
+    (archival.ARCHIVE_URL, ArchiveBatch),
+    (reminders.COLLECT_URL, CollectReminders),
+    (reminders.SEND_URL, SendReminders),
     ('/tasks/cache_average_moves', UpdateAverageMoves),
-], debug=True)
+    ('/tasks/rebuild_leaderboard', RebuildLeaderboard),
+    (ADVANCE_BRACKET_URL, AdvanceBracket),
+    ('/admin/profile', ProfileSummary),
+    ('/admin/export_games', ExportGames),
+    ('/_ah/warmup', Warmup),
+], debug=True))
+warmup.record('import_main', _import_started)
@@ -0,0 +1,136 @@
+"""migrations.py - One-off data migrations.
+
+A migration walks a kind in batches of BATCH_SIZE, one deferred task per
+batch, and records that it is done in its Migration entity. The hourly cron
+job starts every migration that has no Migration entity yet, so a deploy
+that adds a migration needs no manual step and each migration runs once.
+A batch function takes the urlsafe cursor of its batch and returns the
+cursor of the next one, or None after the last batch. rerun() starts a
+migration again, for the admin tasks that repeat one."""
+
+import collections
+from datetime import datetime
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred, ndb
+
+import etags
+import leaderboard
+from models import Game, Migration, MoveRecord, User
+from models import COUNT_ACTIVE_GAMES, INDEX_MOVE_COUNTS, \
+    REBUILD_LEADERBOARD, UNPICKLE_HISTORIES
+
+BATCH_SIZE = 200
+
+_MIGRATIONS = collections.OrderedDict()  # Name to batch function
+
+
+def migration(name):
+    """Decorator registering a batch function as the migration name"""
+    def decorator(function):
+        _MIGRATIONS[name] = function
+        return function
+    return decorator
+
+
+def _fetch_page(query, urlsafe_cursor, **options):
+    """Returns the results of a batch and the urlsafe cursor of the next
+    batch, or None after the last one"""
+    results, cursor, more = query.fetch_page(
+            BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=urlsafe_cursor) if urlsafe_cursor
+            else None, **options)
+    return results, cursor.urlsafe() if more and cursor else None
+
+
+@ndb.transactional_tasklet
+def _unpickle_history_async(game_key):
+    """Moves the pickled history of a game into MoveRecords. Returns a
+    future of whether the game had one."""
+    game = yield game_key.get_async()
+    # ndb keeps the unknown property as a fake GenericProperty
+    prop = game and game._properties.get('history')
+    if not prop:
+        raise ndb.Return(False)
+    records = MoveRecord.from_pickled(game_key, prop._get_value(game))
+    del game._properties['history']
+    game._values.pop('history', None)
+    yield ndb.put_multi_async([game] + records)
+    raise ndb.Return(True)
+
+
+@migration(UNPICKLE_HISTORIES)
+def _unpickle_histories(urlsafe_cursor):
+    """Moves the pickled histories of the games created before MoveRecords
+    into MoveRecords, so loading and saving those games no longer carries
+    the list and their history pages are not empty"""
+    keys, next_cursor = _fetch_page(Game.query(), urlsafe_cursor,
+                                    keys_only=True)
+    futures = [_unpickle_history_async(key) for key in keys]
+    etags.bump([etags.history(key.urlsafe())
+                for key, future in zip(keys, futures) if future.get_result()])
+    return next_cursor
+
+
+@migration(INDEX_MOVE_COUNTS)
+def _index_move_counts(urlsafe_cursor):
+    """Rewrites history records so their moves_count is indexed"""
+    records, next_cursor = _fetch_page(MoveRecord.query(), urlsafe_cursor)
+    ndb.put_multi(records)
+    return next_cursor
+
+
+@migration(COUNT_ACTIVE_GAMES)
+def _count_active_games(urlsafe_cursor):
+    """Counts the games created before the active game counters existed"""
+    Game.recount_active()
+    return None
+
+
+@migration(REBUILD_LEADERBOARD)
+def _rebuild_leaderboard(urlsafe_cursor):
+    """Counts every user in a new generation of the leaderboard tree, which
+    is made live after the last batch, so the users created before the
+    leaderboard are ranked and counts that drifted are replaced"""
+    if urlsafe_cursor:
+        current = leaderboard.tree()
+        if current.building is None:
+            return None  # Finished by another run
+    else:
+        current = leaderboard.start_build()
+    keys, next_cursor = _fetch_page(User.query(), urlsafe_cursor,
+                                    keys_only=True)
+    for key in keys:
+        # One user at a time, as every user is counted in the root node
+        User.rank_async(key, current).get_result()
+    if not next_cursor:
+        leaderboard.finish_build()
+    return next_cursor
+
+
+def start():
+    """Starts every migration that was never started"""
+    names = list(_MIGRATIONS)
+    progress = ndb.get_multi([ndb.Key(Migration, name) for name in names])
+    for name, started in zip(names, progress):
+        if started:
+            continue
+        Migration(id=name, started=datetime.now()).put()
+        deferred.defer(run_batch, name, None)
+
+
+def rerun(name):
+    """Starts a migration again, whether or not it ran before"""
+    Migration(id=name, started=datetime.now()).put()
+    deferred.defer(run_batch, name, None)
+
+
+def run_batch(name, urlsafe_cursor):
+    """Runs one batch of a migration and defers the next one"""
+    next_cursor = _MIGRATIONS[name](urlsafe_cursor)
+    if next_cursor:
+        deferred.defer(run_batch, name, next_cursor)
+        return
+    migration = Migration.get_by_id(name)
+    migration.done = True
+    migration.put()
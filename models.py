@@ -2,11 +2,76 @@
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
+import collections
+import pickle
 import random
-from datetime import date
+from datetime import date, datetime, time, timedelta
 from protorpc import messages
+from google.appengine.api import datastore_errors, memcache, taskqueue
 from google.appengine.ext import ndb
 
+import audit
+import counters
+import engine
+import etags
+import gamecache
+import leaderboard
+import profiling
+
+# Status codes of history records
+MOVE_NO_WINNER = 0
+MOVE_WIN = 1
+MOVE_DRAW = 2
+MOVE_WRONG_TURN_X = 3
+MOVE_WRONG_TURN_O = 4
+MOVE_INVALID = 5
+MOVE_TAKEN = 6
+
+MEMCACHE_USER_KEY = 'USER_KEY:%s'
+
+# Migrations (see migrations.py): moving the pickled histories of older
+# games into MoveRecords, indexing the moves_count of history records,
+# counting the games created before the active game counters and ranking
+# the users created before the leaderboard
+UNPICKLE_HISTORIES = 'unpickle_histories'
+INDEX_MOVE_COUNTS = 'index_move_counts'
+COUNT_ACTIVE_GAMES = 'count_active_games'
+REBUILD_LEADERBOARD = 'rebuild_leaderboard_tree'
+
+# Id of the User that plays for the computer
+COMPUTER_ID = 'computer'
+COMPUTER_NAME = 'Computer'
+
+# Sharded counters of the active games and of the moves made in them
+ACTIVE_GAMES = 'active_games'
+ACTIVE_MOVES = 'active_moves'
+
+# Retries of the transactions writing a game, which also contend on the
+# players, tournament standings and counter shards shared with other games
+TRANSACTION_RETRIES = 3
+
+# Task moving the winner of a bracket game to the next round
+ADVANCE_BRACKET_URL = '/tasks/advance_bracket'
+
+MOVE_MESSAGES = {
+    MOVE_NO_WINNER: 'No winner yet.  Good luck on your next move.',
+    MOVE_WIN: 'You win!',
+    MOVE_DRAW: 'Game over! No winner.',
+    MOVE_WRONG_TURN_X: 'Move rejected.  Next move must be from x_user.',
+    MOVE_WRONG_TURN_O: 'Move rejected.  Next move must be from o_user.',
+    MOVE_INVALID: 'Invalid row move! Choose a cell on the board.',
+    MOVE_TAKEN: 'Move is not longer available.',
+}
+
+# Status codes of the messages of pickled histories
+PICKLED_STATUSES = dict((message, status)
+                        for status, message in MOVE_MESSAGES.items())
+PICKLED_STATUSES['Invalid row move! Choose 0 to 8.'] = MOVE_INVALID
+
+
+class StaleGameError(Exception):
+    """The game was changed by another request since it was loaded"""
+
 
 class User(ndb.Model):
     """User profile"""
@@ -17,6 +82,8 @@ class User(ndb.Model):
     nbr_of_moves_on_wins = ndb.IntegerProperty(required=True, default=0)
     winning_percentage_rate = ndb.FloatProperty(required=True, default=0)
     average_game_moves_on_winning_games = ndb.FloatProperty(required=True, default=0)
+    rank_score = ndb.IntegerProperty()
+    rank_generation = ndb.IntegerProperty(indexed=False)
 
     def rank_form(self):
         """Returns user rankings"""
@@ -28,6 +95,155 @@ class User(ndb.Model):
         form.average_game_moves_on_winning_games = self.average_game_moves_on_winning_games 
         return form
 
+    @classmethod
+    @profiling.timed('User.key_for_name')
+    def key_for_name(cls, name):
+        """Returns the key of the User with a name, or None if there is no
+        such user. Reads through memcache to the UserName index. The
+        computer is never found by name."""
+        return cls.key_for_name_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def key_for_name_async(cls, name):
+        """Returns a future of key_for_name(name), so lookups that do not
+        depend on each other can run concurrently"""
+        if not name or name == COMPUTER_NAME:
+            raise ndb.Return(None)
+        context = ndb.get_context()
+        cache_key = MEMCACHE_USER_KEY % name
+        urlsafe = yield context.memcache_get(cache_key)
+        if urlsafe:
+            raise ndb.Return(ndb.Key(urlsafe=urlsafe))
+        index = yield UserName.get_by_id_async(name)
+        if index:
+            key = index.user
+        else:
+            # Users created before the UserName index are indexed on first use
+            key = yield cls.query(cls.name == name).get_async(keys_only=True)
+            if not key:
+                raise ndb.Return(None)
+            yield UserName(id=name, user=key).put_async()
+        yield context.memcache_set(cache_key, key.urlsafe())
+        raise ndb.Return(key)
+
+    @classmethod
+    def keys_for_names(cls, names):
+        """Returns the keys of the Users with the given names, in order,
+        with None for unknown names. Reads through memcache to the UserName
+        index with one batch call each."""
+        prefix = MEMCACHE_USER_KEY % ''
+        keys = dict((name, ndb.Key(urlsafe=urlsafe)) for name, urlsafe in
+                    memcache.get_multi(names, key_prefix=prefix).items())
+        missing = [name for name in names if name not in keys]
+        indexes = ndb.get_multi([ndb.Key(UserName, name) for name in missing])
+        found = {}
+        unindexed = {}
+        for name, index in zip(missing, indexes):
+            if index:
+                keys[name] = found[name] = index.user
+            else:
+                unindexed[name] = cls.key_for_name_async(name)
+        for name, future in unindexed.items():
+            keys[name] = future.get_result()
+        memcache.set_multi(dict((name, key.urlsafe())
+                                for name, key in found.items()),
+                           key_prefix=prefix)
+        return [None if name == COMPUTER_NAME else keys[name]
+                for name in names]
+
+    @classmethod
+    def create(cls, name, email):
+        """Creates and returns a User. Returns None if the name is taken or
+        reserved for the computer."""
+        if name == COMPUTER_NAME or cls.key_for_name(name):
+            return None
+        user = cls(id=cls.allocate_ids(1)[0], name=name, email=email)
+        user.rank_score = leaderboard.score(user)
+        moves = leaderboard.place(user, None)
+
+        @ndb.transactional(xg=True)
+        def _create():
+            if UserName.get_by_id(name):
+                return None
+            ndb.put_multi([user, UserName(id=name, user=user.key)])
+            return user
+
+        created = _create()
+        memcache.delete(MEMCACHE_USER_KEY % name)
+        if created:
+            leaderboard.record(moves)
+        return created
+
+    @classmethod
+    def computer_key(cls):
+        """Returns the key of the User that plays for the computer, creating
+        the user on first use. Its name is reserved in the UserName index,
+        and it has no rank score, so it is left out of the leaderboard."""
+        key = ndb.Key(cls, COMPUTER_ID)
+        if key.get():
+            return key
+        user = cls(key=key, name=COMPUTER_NAME, email='noreply@localhost')
+
+        @ndb.transactional(xg=True)
+        def _insert():
+            if key.get():
+                return
+            ndb.put_multi([user, UserName(id=COMPUTER_NAME, user=key)])
+
+        _insert()
+        return key
+
+    def is_computer(self):
+        """Checks if the user plays for the computer"""
+        return self.key.id() == COMPUTER_ID
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def rank_async(cls, key, current):
+        """Recomputes the rank score of a User and counts the user in the
+        tree being built (see leaderboard.start_build), with the user
+        re-read in the same transaction as the counts, so games that end
+        meanwhile are neither lost nor counted twice. current is the
+        RankTree of the build. Returns a future of whether the user was
+        counted."""
+        user = yield key.get_async()
+        if not user or user.rank_generation == current.building:
+            raise ndb.Return(False)
+        if user.is_computer():
+            if user.rank_score is None:
+                raise ndb.Return(False)
+            # Scored before the computer was kept off the leaderboard
+            user.rank_score = None
+            yield user.put_async()
+            raise ndb.Return(True)
+        old_score = user.rank_score
+        user.rank_score = leaderboard.score(user)
+        moves = leaderboard.place(user, old_score, current)
+        yield user.put_async(), leaderboard.apply_async(moves)
+        raise ndb.Return(True)
+
+
+def user_names(user_keys):
+    """Returns a dict of user key to name, fetching every distinct user with
+    one get_multi"""
+    return user_names_async(user_keys).get_result()
+
+
+@ndb.tasklet
+def user_names_async(user_keys):
+    """Returns a future of user_names(user_keys)"""
+    users = yield ndb.get_multi_async(list(set(user_keys)))
+    raise ndb.Return(dict((user.key, user.name) for user in users if user))
+
+
+class UserName(ndb.Model):
+    """Unique index of user names. Keyed by name and points to the User.
+    Cached in memcache by User.key_for_name, so ndb's own cache is off."""
+    _use_memcache = False
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+
+
 class UserGame(ndb.Model):
     """User Games"""
     user = ndb.KeyProperty(required=True, kind='User')
@@ -36,114 +252,728 @@ class UserGame(ndb.Model):
     win_status = ndb.StringProperty()
     moves_count = ndb.IntegerProperty()
 
-    def to_form(self):
+    @classmethod
+    def keys_for(cls, game_key):
+        """Returns the keys of the X and O player rows of a game"""
+        return [ndb.Key(cls, '{}-x'.format(game_key.id())),
+                ndb.Key(cls, '{}-o'.format(game_key.id()))]
+
+    def to_form(self, user_name, game_over):
         """Returns user's game infromation"""
         form = UserGameForm()
-        form.user_name = self.user.get().name
+        form.user_name = user_name
         form.game_key = self.game_key.urlsafe()
-        form.game_over = self.game_over
+        form.game_over = game_over
         form.win_status = self.win_status
-        moves_count = self.moves_count
+        form.moves_count = self.moves_count
         return form
 
+    @staticmethod
+    def to_forms(usergames, game_over, user_name=None):
+        """Returns UserGameForm representations of usergames, which may be
+        projections. game_over, and user_name when the query is filtered on
+        the user, come from the query filters. Otherwise all the users the
+        rows refer to are fetched with one get_multi."""
+        usergames = list(usergames)
+        if user_name is None:
+            names = user_names(usergame.user for usergame in usergames)
+            return [usergame.to_form(names.get(usergame.user), game_over)
+                    for usergame in usergames]
+        return [usergame.to_form(user_name, game_over)
+                for usergame in usergames]
+
 
 class Game(ndb.Model):
-    """Game object"""
+    """Game object. The board is stored compactly as a packed integer in
+    board (see engine.py), or as bytes in wide_board when it does not fit a
+    64 bit integer; game_moves is only read for games created before board
+    existed and is cleared on their next move. The board is board_size cells
+    wide and win_length marks in a row win. move_sequence holds the cells
+    played so far, one byte each, for games created since it existed."""
     game_over = ndb.BooleanProperty(required=True, default=False)
     game_moves = ndb.StringProperty(repeated=True)
+    board = ndb.IntegerProperty(indexed=False)
+    wide_board = ndb.BlobProperty()
+    move_sequence = ndb.BlobProperty()
+    board_size = ndb.IntegerProperty(default=engine.BOARD_SIZE, indexed=False)
+    win_length = ndb.IntegerProperty(default=engine.WIN_LENGTH, indexed=False)
     x_user = ndb.KeyProperty(required=True, kind='User')
     o_user = ndb.KeyProperty(required=True, kind='User')
     moves_count = ndb.IntegerProperty(required=True)
     game_end_date = ndb.DateProperty()
-    history = ndb.PickleProperty(default=[])
+    version = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    ai_level = ndb.StringProperty(indexed=False)
+    tournament = ndb.KeyProperty(kind='Tournament', indexed=False)
+    tournament_match = ndb.KeyProperty(kind='TournamentMatch', indexed=False)
+
+    @classmethod
+    def new_game(cls, x_user, o_user, ai_level=None,
+                 board_size=engine.BOARD_SIZE, win_length=engine.WIN_LENGTH):
+        """Creates and returns a new game. ai_level is the level of the
+        computer player (see ai.py), if one of the users is the computer."""
+        key = ndb.Key(cls, cls.allocate_ids(1)[0])
+        entities = cls.build(key, x_user, o_user, ai_level=ai_level,
+                             board_size=board_size, win_length=win_length)
+        entities[0].prefetch_names()
+        ndb.put_multi(entities)
+        counters.increment({ACTIVE_GAMES: 1})
+        return entities[0]
 
     @classmethod
-    def new_game(cls, x_user, o_user, game_moves):
-        """Creates and returns a new game"""
-        game = Game(x_user=x_user,
+    def recount_active(cls):
+        """Recounts the active games and their moves into the ACTIVE_GAMES
+        and ACTIVE_MOVES counters"""
+        games = cls.query(cls.game_over == False).iter(
+                projection=[cls.moves_count], batch_size=500)
+        count = total_moves = 0
+        for game in games:
+            count += 1
+            total_moves += game.moves_count
+        counters.reset({ACTIVE_GAMES: count, ACTIVE_MOVES: total_moves})
+
+    @classmethod
+    def build(cls, key, x_user, o_user, **properties):
+        """Returns a new, unsaved game with the given key followed by its
+        two UserGame rows"""
+        game = Game(key=key,
+                    x_user=x_user,
                     o_user=o_user,
-                    game_moves=game_moves,
                     moves_count=0,
-                    game_over=False)
-        game.put()
-        usergame = UserGame(user=x_user, 
-                            game_key=game.key,
-                            moves_count=0,
-                            game_over=False)
-        usergame.put()
-        usergame = UserGame(user=o_user, 
-                            game_key=game.key,
-                            moves_count=0,
-                            game_over=False)
-        usergame.put()
-        return game
+                    game_over=False,
+                    **properties)
+        game.set_board(engine.EMPTY)
+        x_key, o_key = UserGame.keys_for(key)
+        return [game,
+                UserGame(key=x_key,
+                         user=x_user,
+                         game_key=key,
+                         moves_count=0,
+                         game_over=False),
+                UserGame(key=o_key,
+                         user=o_user,
+                         game_key=key,
+                         moves_count=0,
+                         game_over=False)]
 
+    @profiling.timed('Game.to_form')
     def to_form(self, message):
         """Returns a GameForm representation of the Game"""
-        form = GameForm()
-        form.urlsafe_key = self.key.urlsafe()
-        form.x_user_name = self.x_user.get().name
-        form.o_user_name = self.o_user.get().name
-        form.moves_count = self.moves_count
-        form.game_moves = self.game_moves
-        form.game_over = self.game_over
-        form.game_end_date = str(self.game_end_date)
-        form.message = message
-        return form
+        return self.state().to_form(self.key.urlsafe(), message)
+
+    def prefetch_names(self):
+        """Starts looking up the player names state() needs, so the lookup
+        runs concurrently with the rest of the request. The names are looked
+        up once per Game object."""
+        if getattr(self, '_names', None) is None:
+            self._names = user_names_async([self.x_user, self.o_user])
+
+    def state(self):
+        """Returns the GameState of the Game"""
+        self.prefetch_names()
+        names = self._names.get_result()
+        return GameState(version=self.version,
+                         board=self.current_board(),
+                         moves_count=self.moves_count,
+                         x_user_name=names.get(self.x_user),
+                         o_user_name=names.get(self.o_user),
+                         game_over=self.game_over,
+                         game_end_date=str(self.game_end_date),
+                         ai_level=self.ai_level,
+                         board_size=self.board_size,
+                         win_length=self.win_length)
+
+    def current_board(self):
+        """Returns the packed board of the game"""
+        if self.wide_board is not None:
+            return engine.from_bytes(self.wide_board)
+        if self.board is None:
+            return engine.from_cells(self.game_moves)
+        return self.board
 
-    def end_game(self, winner):
-        """Ends the game"""
-        items = UserGame.query(UserGame.game_key == self.key)  
-        for item in items:
+    def final_outcome(self, moves):
+        """Returns the engine outcome of the finished game, given the cells
+        played in order. Games without moves are only judged on a 3 x 3
+        board."""
+        board = self.current_board()
+        if moves:
+            return engine.outcome_after(board, ord(moves[-1]),
+                                        self.board_size, self.win_length)
+        if self.board_size == engine.BOARD_SIZE:
+            return engine.outcome(board)
+        return engine.IN_PROGRESS
+
+    def set_board(self, board):
+        """Stores the packed board, dropping any legacy game_moves list"""
+        if engine.fits_integer(self.board_size):
+            self.board = board
+        else:
+            self.wide_board = engine.to_bytes(board)
+        self.game_moves = []
+
+    def is_cell(self, cell):
+        """Checks that cell is on the board"""
+        return engine.is_cell(cell, self.board_size)
+
+    def is_free(self, cell):
+        """Checks that cell is on the board and not taken"""
+        return engine.is_free(self.current_board(), cell, self.board_size)
+
+    def next_player(self):
+        """Returns engine.X or engine.O, whichever moves next"""
+        if self.moves_count % 2 == 0:
+            return engine.X
+        return engine.O
+
+    def next_user(self):
+        """Returns the key of the user who moves next"""
+        if self.next_player() == engine.X:
+            return self.x_user
+        return self.o_user
+
+    def computer_to_move(self):
+        """Checks if the computer moves next"""
+        return (bool(self.ai_level) and not self.game_over and
+                self.next_user().id() == COMPUTER_ID)
+
+    def apply_move(self, user, cell):
+        """Plays a free cell for the user who moves next and records it in
+        the history. Returns MOVE_WIN, MOVE_DRAW or MOVE_NO_WINNER."""
+        board = engine.place(self.current_board(), cell, self.next_player(),
+                             self.board_size)
+        self.set_board(board)
+        if self.moves_count == 0 or self.move_sequence:
+            self.move_sequence = (self.move_sequence or '') + chr(cell)
+        self.moves_count += 1
+        outcome = engine.outcome_after(board, cell, self.board_size,
+                                       self.win_length)
+        if outcome == engine.DRAW:
+            status = MOVE_DRAW
+        elif outcome != engine.IN_PROGRESS:
+            status = MOVE_WIN
+        else:
+            status = MOVE_NO_WINNER
+        self.post_history(user, self.moves_count, cell, status)
+        return status
+
+    def play_computer(self):
+        """Plays the computer's reply. Returns the (cell, status) of the
+        move, see apply_move."""
+        import ai
+        cell = ai.reply(self.current_board(), self.next_player(),
+                        self.ai_level)
+        return cell, self.apply_move(self.next_user(), cell)
+
+    @profiling.timed('Game.end_game')
+    def end_game(self, winner, moves_made=0):
+        """Ends the game. The game, its new history and the UserGame rows,
+        stats and tournament standings of both players are written with one
+        put_multi in a single cross-group transaction. The transaction is
+        retried when it fails on contention while the game version is still
+        current, such as two games of a player ending together. moves_made
+        is the number of moves made since the game was loaded, which the
+        ACTIVE_MOVES counter has not counted. Raises StaleGameError if the
+        game changed since it was loaded."""
+        self.game_over = True
+        self.game_end_date = date.today()
+        rejected, records = self._take_history()
+        records = rejected + records
+        rank_tree = leaderboard.tree()
+        version = self.version
+        try:
+            moves = self._end_game(winner, UserGame.keys_for(self.key),
+                                   records, rank_tree, version, True)
+            if moves is None:
+                # Games created before UserGame rows had predictable keys
+                keys = UserGame.query(UserGame.game_key == self.key).fetch(
+                        keys_only=True)
+                moves = self._end_game(winner, keys, records, rank_tree,
+                                       version, False)
+        except datastore_errors.TransactionFailedError:
+            audit.restore(self.key, rejected)
+            self._raise_if_stale(version)
+            raise
+        except Exception:
+            audit.restore(self.key, rejected)
+            raise
+        gamecache.invalidate(self.key, self.moves_count)
+        etags.bump([etags.history(self.key.urlsafe()), etags.SCORES])
+        if winner:
+            # The stats of the players changed even if their scores did not
+            leaderboard.record(moves)
+        counters.increment({ACTIVE_GAMES: -1,
+                            ACTIVE_MOVES: moves_made - self.moves_count})
+
+    @ndb.transactional(xg=True, retries=TRANSACTION_RETRIES)
+    def _end_game(self, winner, usergame_keys, records, rank_tree, version,
+                  strict):
+        """Records the end of the game for its players. version is the
+        version the game was loaded with. Returns the leaderboard moves of
+        the players (see leaderboard.place), or None without writing
+        anything if strict and a UserGame row is missing."""
+        # A retry checks the version the game was loaded with again, and a
+        # version that moved on fails it with StaleGameError
+        self.version = version
+        # The UserGame rows, players and standings are read together with
+        # the version check
+        user_keys = list(set([self.x_user, self.o_user])) if winner else []
+        standing_keys = []
+        if self.tournament:
+            standing_keys = [TournamentStanding.key_for(self.tournament, key)
+                             for key in (self.x_user, self.o_user)]
+        usergame_futures, user_futures, standing_futures = [
+                ndb.get_multi_async(keys)
+                for keys in (usergame_keys, user_keys, standing_keys)]
+        self._check_version()
+        usergames = [future.get_result() for future in usergame_futures]
+        if None in usergames:
+            if strict:
+                return None
+            usergames = [item for item in usergames if item]
+        users = dict((key, future.get_result())
+                     for key, future in zip(user_keys, user_futures))
+        moves = []
+        for item in usergames:
             if (winner):
-                user = User.query(User.key == item.user).get()
+                user = users[item.user]
                 if (winner == item.user): 
                     item.win_status = "WIN"
                     user.nbr_wins = user.nbr_wins + 1
                     user.nbr_of_moves_on_wins += self.moves_count
-                    user.average_game_moves_on_winning_games = (user.nbr_of_moves_on_wins / user.nbr_wins)
+                    user.average_game_moves_on_winning_games = (float(user.nbr_of_moves_on_wins) / user.nbr_wins)
                 else:
                     item.win_status = "LOSE"
                     user.nbr_loses = user.nbr_loses + 1
-                user.winning_percentage_rate = (user.nbr_wins/(user.nbr_wins + user.nbr_loses)) * 100.0
-                user.put()
+                user.winning_percentage_rate = (100.0 * user.nbr_wins / (user.nbr_wins + user.nbr_loses))
+                if not user.is_computer():
+                    old_score = user.rank_score
+                    user.rank_score = leaderboard.score(user)
+                    moves.extend(leaderboard.place(user, old_score,
+                                                   rank_tree))
             else:
                 item.win_status = "DRAW"           
             item.moves_count = self.moves_count
             item.game_over = True
-            item.put() 
-             
-        self.game_over = True
-        self.game_end_date = date.today()
-        self.put()
+        standings = [future.get_result() for future in standing_futures]
+        standings = [standing for standing in standings if standing]
+        for standing in standings:
+            standing.add_result(winner)
+        if self.tournament_match:
+            taskqueue.add(url=ADVANCE_BRACKET_URL,
+                          params={'game': self.key.urlsafe(),
+                                  'winner': winner.urlsafe() if winner else ''},
+                          transactional=True)
+        self.version = version + 1
+        ndb.put_multi([self] + users.values() + usergames + standings +
+                      records)
+        return moves
 
     def cancel_game(self):
         """Cancel's game by deleting records of the game"""
-        ndb.delete_multi(UserGame.query(UserGame.game_key == self.key).fetch(keys_only=True))    
+        audit.drain(self.key)
+        usergames = UserGame.query(UserGame.game_key == self.key).fetch_async(
+                keys_only=True)
+        records = MoveRecord.query(ancestor=self.key).fetch_async(
+                keys_only=True)
+        keys = usergames.get_result() + records.get_result()
+        keys.append(self.key)
+        ndb.delete_multi(keys)
+        gamecache.invalidate(self.key, gamecache.CANCELLED)
+        etags.bump([etags.history(self.key.urlsafe())])
+        counters.increment({ACTIVE_GAMES: -1, ACTIVE_MOVES: -self.moves_count})
+
+    def post_history(self, user, moves_count, move, status):
+        """Records game history. The record, along with the buffered records
+        of rejected moves, is written by the next commit() of the game"""
+        self._new_history = (getattr(self, '_new_history', []) +
+                             [MoveRecord.new(self.key, user, moves_count,
+                                             move, status)])
+
+    def post_rejected_move(self, user, moves_count, move, status):
+        """Records the history of a rejected move without writing the game"""
+        audit.record(self.key,
+                     MoveRecord.new(self.key, user, moves_count, move, status))
+
+    @profiling.timed('Game.commit')
+    def commit(self, moves_made=0):
+        """Writes the game, its new history and moves_made, the number of
+        moves made since it was loaded, to a shard of the ACTIVE_MOVES
+        counter with one put_multi, and its state through to the game
+        cache. Raises StaleGameError if the game changed since it was
+        loaded."""
+        rejected, records = self._take_history()
+        deltas = {ACTIVE_MOVES: moves_made}
+        version = self.version
+        try:
+            self._commit(rejected + records, deltas, version)
+        except datastore_errors.TransactionFailedError:
+            audit.restore(self.key, rejected)
+            self._raise_if_stale(version)
+            raise
+        except Exception:
+            audit.restore(self.key, rejected)
+            raise
+        counters.add_to_totals(deltas)
+        gamecache.update(self)
+        etags.bump([etags.history(self.key.urlsafe())])
 
-        k = self.key
-        k.delete()
+    @ndb.transactional(xg=True, retries=TRANSACTION_RETRIES)
+    def _commit(self, records, deltas, version):
+        self.version = version
+        shards = counters.add_to_shards(deltas)
+        self._check_version()
+        self.version = version + 1
+        ndb.put_multi([self] + records + shards)
 
-    def post_history(self, user, moves_count, move, message):
-        """Records game history"""
-        self.history.append({'date': date.today(), 
-                             'user': user,
-                             'moves_count': moves_count,
-                             'move': move,
-                             'message': message})
-        self.put()
+    def _check_version(self):
+        """Checks, in a transaction, that the stored game still has the
+        version this one was loaded with. Concurrent moves are detected here
+        or by the transaction's commit. A transaction that failed on
+        contention is retried, and fails fast here once the version moved
+        on."""
+        stored = self.key.get()
+        if not stored or stored.version != self.version:
+            raise StaleGameError()
+
+    def _raise_if_stale(self, version):
+        """Puts back the version the game was loaded with after a failed
+        transaction, and raises StaleGameError if the stored game moved
+        past it"""
+        self.version = version
+        stored = self.key.get(use_cache=False, use_memcache=False)
+        if not stored or stored.version != version:
+            raise StaleGameError()
+
+    def _take_history(self):
+        """Returns the buffered records of the game's rejected moves and its
+        new history records, and forgets them. The rejected move records
+        are buffered again if the write fails."""
+        records = getattr(self, '_new_history', [])
+        self._new_history = []
+        return audit.drain(self.key), records
+
+
+class MoveRecord(ndb.Model):
+    """History record of a move. Stored as a child of its Game so the game
+    entity stays the same size however long its history grows."""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    moves_count = ndb.IntegerProperty(required=True)
+    move = ndb.IntegerProperty(indexed=False)
+    status = ndb.IntegerProperty(required=True, indexed=False)
+    date = ndb.DateTimeProperty(required=True)
+
+    @classmethod
+    def new(cls, game_key, user, moves_count, move, status):
+        """Returns a new, unsaved history record of a game"""
+        return cls(parent=game_key,
+                   user=user,
+                   moves_count=moves_count,
+                   move=move,
+                   status=status,
+                   date=datetime.now())
+
+    @classmethod
+    def query_game(cls, game_key):
+        """Returns a query of the history of a game in move order. Records
+        of the same move are ordered by date. Until the records written
+        before moves_count was indexed are migrated, the history is ordered
+        by date alone, as those records are missing from the moves_count
+        index."""
+        if not Migration.is_done(INDEX_MOVE_COUNTS):
+            return cls.query(ancestor=game_key).order(cls.date)
+        return cls.query(ancestor=game_key).order(cls.moves_count, cls.date)
+
+    @classmethod
+    def from_pickled(cls, game_key, pickled):
+        """Returns the unsaved history records of the pickled history list
+        of a game created before MoveRecords existed. Those entries are
+        dated by day, so entries are a microsecond apart to keep their
+        order."""
+        return [cls(parent=game_key,
+                    user=entry['user'],
+                    moves_count=entry['moves_count'],
+                    move=entry['move'],
+                    status=PICKLED_STATUSES.get(entry['message'],
+                                                MOVE_INVALID),
+                    date=datetime.combine(entry['date'], time()) +
+                    timedelta(microseconds=index))
+                for index, entry in enumerate(pickle.loads(pickled))]
+
+    @staticmethod
+    def in_order(records):
+        """Returns history records in move order, without relying on the
+        clocks of the instances that dated them"""
+        return sorted(records,
+                      key=lambda record: (record.moves_count, record.date))
+
+    @staticmethod
+    def accepted_moves(records):
+        """Returns the cells played in a game, one byte each in order, from
+        its history records"""
+        played = sorted((record.moves_count, record.move)
+                        for record in records if record.status in
+                        (MOVE_NO_WINNER, MOVE_WIN, MOVE_DRAW))
+        return ''.join(chr(move) for moves_count, move in played)
+
+    @staticmethod
+    def to_forms(records):
+        """Returns MoveRecordForm representations of history records"""
+        names = user_names(record.user for record in records)
+        return [MoveRecordForm(user_name=names.get(record.user),
+                               moves_count=record.moves_count,
+                               move=record.move,
+                               message=MOVE_MESSAGES[record.status],
+                               date=str(record.date))
+                for record in records]
+
+
+class ArchivedGame(ndb.Model):
+    """Compact summary of a finished game, with its history, that replaced
+    the Game and its MoveRecords once the game was older than the retention
+    period (see archival.py). Shares its id with the Game, so the game's
+    urlsafe key still finds it. Nothing is indexed."""
+    x_user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    o_user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    board = ndb.IntegerProperty(indexed=False)
+    wide_board = ndb.BlobProperty()
+    board_size = ndb.IntegerProperty(required=True, indexed=False)
+    win_length = ndb.IntegerProperty(required=True, indexed=False)
+    move_sequence = ndb.BlobProperty()
+    moves_count = ndb.IntegerProperty(required=True, indexed=False)
+    outcome = ndb.IntegerProperty(required=True, indexed=False)
+    winner = ndb.KeyProperty(kind='User', indexed=False)
+    game_end_date = ndb.DateProperty(indexed=False)
+    version = ndb.IntegerProperty(required=True, indexed=False)
+    ai_level = ndb.StringProperty(indexed=False)
+    history = ndb.LocalStructuredProperty(MoveRecord, repeated=True,
+                                          compressed=True)
+
+    @classmethod
+    def key_for(cls, game_key):
+        """Returns the key of the archive of a game"""
+        return ndb.Key(cls, game_key.id())
+
+    @classmethod
+    def from_game(cls, game, records):
+        """Returns the unsaved archive of a finished game and its history
+        records"""
+        records = MoveRecord.in_order(records)
+        moves = game.move_sequence or MoveRecord.accepted_moves(records)
+        outcome = game.final_outcome(moves)
+        board = game.current_board()
+        return cls(key=cls.key_for(game.key),
+                   x_user=game.x_user,
+                   o_user=game.o_user,
+                   board=board if engine.fits_integer(game.board_size)
+                   else None,
+                   wide_board=game.wide_board,
+                   board_size=game.board_size,
+                   win_length=game.win_length,
+                   move_sequence=moves,
+                   moves_count=game.moves_count,
+                   outcome=outcome,
+                   winner={engine.X_WINS: game.x_user,
+                           engine.O_WINS: game.o_user}.get(outcome),
+                   game_end_date=game.game_end_date,
+                   version=game.version,
+                   ai_level=game.ai_level,
+                   history=records)
+
+    def current_board(self):
+        """Returns the packed final board of the game"""
+        if self.wide_board is not None:
+            return engine.from_bytes(self.wide_board)
+        return self.board
+
+    def final_outcome(self, moves):
+        """Returns the engine outcome of the game"""
+        return self.outcome
+
+    def state(self):
+        """Returns the GameState of the game, as it was when it ended"""
+        names = user_names([self.x_user, self.o_user])
+        return GameState(version=self.version,
+                         board=self.current_board(),
+                         moves_count=self.moves_count,
+                         x_user_name=names.get(self.x_user),
+                         o_user_name=names.get(self.o_user),
+                         game_over=True,
+                         game_end_date=str(self.game_end_date),
+                         ai_level=self.ai_level,
+                         board_size=self.board_size,
+                         win_length=self.win_length)
+
+
+class Tournament(ndb.Model):
+    """Tournament between users, in seed order (see tournaments.py)"""
+    format = ndb.StringProperty(required=True, indexed=False)
+    players = ndb.KeyProperty(kind='User', repeated=True, indexed=False)
+    games_count = ndb.IntegerProperty(required=True, default=0,
+                                      indexed=False)
+    winner = ndb.KeyProperty(kind='User', indexed=False)
+    date = ndb.DateProperty(required=True)
+
+    def standings(self):
+        """Returns the TournamentStanding of every player"""
+        return ndb.get_multi([TournamentStanding.key_for(self.key, key)
+                              for key in self.players])
+
+    def to_form(self, standings):
+        """Returns a TournamentForm representation of the Tournament"""
+        form = TournamentForm()
+        form.urlsafe_key = self.key.urlsafe()
+        form.format = self.format
+        form.games_count = self.games_count
+        form.standings = [standing.to_form() for standing in sorted(
+                standings, key=lambda item: (-item.wins, item.losses))]
+        for standing in standings:
+            if standing.user == self.winner:
+                form.winner_name = standing.name
+        return form
+
+
+class TournamentStanding(ndb.Model):
+    """Results of a user in a tournament. Keyed by tournament and user, so
+    games ending at once in a tournament do not contend on one entity
+    group."""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    name = ndb.StringProperty(required=True, indexed=False)
+    wins = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    losses = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    draws = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+    @classmethod
+    def key_for(cls, tournament_key, user_key):
+        """Returns the key of a user's standing in a tournament"""
+        return ndb.Key(cls, '{}:{}'.format(tournament_key.id(), user_key.id()))
+
+    def add_result(self, winner):
+        """Counts a game of the user won by winner, a draw if winner is
+        empty"""
+        if not winner:
+            self.draws += 1
+        elif winner == self.user:
+            self.wins += 1
+        else:
+            self.losses += 1
+
+    def to_form(self):
+        return StandingForm(user_name=self.name, wins=self.wins,
+                            losses=self.losses, draws=self.draws)
+
+
+class TournamentMatch(ndb.Model):
+    """A pairing of a bracket tournament, from its first game to its
+    winner. Child of the Tournament, keyed by round and slot."""
+    round = ndb.IntegerProperty(required=True, indexed=False)
+    slot = ndb.IntegerProperty(required=True, indexed=False)
+    x_user = ndb.KeyProperty(kind='User', indexed=False)
+    o_user = ndb.KeyProperty(kind='User', indexed=False)
+    game = ndb.KeyProperty(kind='Game', indexed=False)
+    winner = ndb.KeyProperty(kind='User', indexed=False)
+
+    @classmethod
+    def key_for(cls, tournament_key, round, slot):
+        """Returns the key of the match in a slot of a round"""
+        return ndb.Key(cls, '{}:{}'.format(round, slot), parent=tournament_key)
+
+
+class Migration(ndb.Model):
+    """Progress of a one-off data migration, keyed by its name (see
+    migrations.py)"""
+    started = ndb.DateTimeProperty(required=True, indexed=False)
+    done = ndb.BooleanProperty(required=True, default=False, indexed=False)
+
+    _done = set()  # Names of the migrations known to be done
+
+    @classmethod
+    def is_done(cls, name):
+        """Checks if a migration is done. Once it is, the answer is kept by
+        the instance."""
+        if name not in cls._done:
+            migration = cls.get_by_id(name)
+            if not migration or not migration.done:
+                return False
+            cls._done.add(name)
+        return True
+
+
+class ReminderRun(ndb.Model):
+    """Progress of a run of the reminder pipeline (see reminders.py)"""
+    started = ndb.DateTimeProperty(required=True)
+    cursor = ndb.StringProperty(indexed=False)
+    collected = ndb.BooleanProperty(required=True, default=False)
+    send_cursor = ndb.StringProperty(indexed=False)
+
+
+class ReminderDigest(ndb.Model):
+    """The reminders of one user in a run. Child of the ReminderRun."""
+    name = ndb.StringProperty(required=True, indexed=False)
+    email = ndb.StringProperty(required=True, indexed=False)
+    game_keys = ndb.KeyProperty(kind='Game', repeated=True, indexed=False)
+    lines = ndb.TextProperty(repeated=True)
+
+    @classmethod
+    def key_for(cls, run_key, user_key):
+        """Returns the key of a user's digest in a run"""
+        return ndb.Key(cls, user_key.urlsafe(), parent=run_key)
+
+    def body(self):
+        """Returns the email body of the digest"""
+        if len(self.lines) == 1:
+            return 'Hello {}, It is your turn to win the game! {}'.format(
+                    self.name, self.lines[0])
+        return 'Hello {}, It is your turn in {} games:\n{}'.format(
+                self.name, len(self.lines),
+                '\n'.join(' - ' + line for line in self.lines))
+
+
+class GameState(collections.namedtuple('GameState', [
+        'version', 'board', 'moves_count', 'x_user_name', 'o_user_name',
+        'game_over', 'game_end_date', 'ai_level', 'board_size',
+        'win_length'])):
+    """Compact state of a game: everything in its GameForm but the key and
+    message. Cached in memcache by gamecache.py."""
+    __slots__ = ()
+
+    def to_form(self, urlsafe_key, message):
+        """Returns the GameForm of the state"""
+        return GameForm(urlsafe_key=urlsafe_key,
+                        game_over=self.game_over,
+                        game_end_date=self.game_end_date,
+                        message=message,
+                        x_user_name=self.x_user_name,
+                        o_user_name=self.o_user_name,
+                        moves_count=self.moves_count,
+                        game_moves=engine.to_cells(self.board,
+                                                   self.board_size),
+                        version=self.version,
+                        ai_level=self.ai_level,
+                        board_size=self.board_size,
+                        win_length=self.win_length,
+                        etag=self.etag(urlsafe_key))
+
+    def etag(self, urlsafe_key):
+        """Returns the etag of the state of the game with a urlsafe key.
+        Games at the same version have different etags."""
+        return etags.make('game', urlsafe_key, self.version)
 
 
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
     urlsafe_key = messages.StringField(1, required=True)
-    game_over = messages.BooleanField(2, required=True)
+    game_over = messages.BooleanField(2)
     game_end_date = messages.StringField(3)
     message = messages.StringField(4, required=True)
-    x_user_name = messages.StringField(5, required=True)
-    o_user_name = messages.StringField(6, required=True)
+    x_user_name = messages.StringField(5)
+    o_user_name = messages.StringField(6)
     moves_count = messages.IntegerField(7)
     game_moves = messages.StringField(8, repeated=True)
+    version = messages.IntegerField(9)
+    ai_level = messages.StringField(10)
+    board_size = messages.IntegerField(11)
+    win_length = messages.IntegerField(12)
+    etag = messages.StringField(13)
+    not_modified = messages.BooleanField(14)
 
 class GameForms(messages.Message):
     """Return multiple GameForm"""
@@ -151,15 +981,21 @@ class GameForms(messages.Message):
 
 
 class NewGameForm(messages.Message):
-    """Used to create a new game"""
-    x_user_name = messages.StringField(1, required=True)
-    o_user_name = messages.StringField(2, required=True)
+    """Used to create a new game. To play the computer, give ai_level and
+    the name of the one human player. board_size and win_length default to
+    3 in a row on a 3 x 3 board."""
+    x_user_name = messages.StringField(1)
+    o_user_name = messages.StringField(2)
+    ai_level = messages.StringField(3)
+    board_size = messages.IntegerField(4)
+    win_length = messages.IntegerField(5)
 
 
 class MakeMoveForm(messages.Message):
     """Used to make a move in an existing game"""
     user_name = messages.StringField(1, required=True)
     move = messages.IntegerField(2, required=True)
+    expected_version = messages.IntegerField(3)
 
 
 class UserGameForm(messages.Message):
@@ -174,6 +1010,9 @@ class UserGameForm(messages.Message):
 class UserGameForms(messages.Message):
     """Return multiple UserGameForm"""
     items = messages.MessageField(UserGameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+    etag = messages.StringField(3)
+    not_modified = messages.BooleanField(4)
 
 
 class UserRankingForm(messages.Message):
@@ -183,11 +1022,56 @@ class UserRankingForm(messages.Message):
     nbr_loses = messages.IntegerField(3)
     winning_percentage_rate = messages.FloatField(4)
     average_game_moves_on_winning_games = messages.FloatField(5)
+    rank = messages.IntegerField(6)
 
 
 class UserRankingForms(messages.Message):
     """Return multiple UserRankingForm"""
     items = messages.MessageField(UserRankingForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+    etag = messages.StringField(3)
+    not_modified = messages.BooleanField(4)
+
+
+class MoveRecordForm(messages.Message):
+    """MoveRecordForm for outbound game history information"""
+    user_name = messages.StringField(1)
+    moves_count = messages.IntegerField(2)
+    move = messages.IntegerField(3)
+    message = messages.StringField(4, required=True)
+    date = messages.StringField(5)
+
+
+class MoveRecordForms(messages.Message):
+    """Return a page of MoveRecordForm"""
+    items = messages.MessageField(MoveRecordForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+    etag = messages.StringField(3)
+    not_modified = messages.BooleanField(4)
+
+
+class NewTournamentForm(messages.Message):
+    """Used to create a tournament. format is round_robin or bracket and
+    users are seeded in the order of user_names."""
+    user_names = messages.StringField(1, repeated=True)
+    format = messages.StringField(2, required=True)
+
+
+class StandingForm(messages.Message):
+    """Results of a user in a tournament"""
+    user_name = messages.StringField(1, required=True)
+    wins = messages.IntegerField(2)
+    losses = messages.IntegerField(3)
+    draws = messages.IntegerField(4)
+
+
+class TournamentForm(messages.Message):
+    """TournamentForm for outbound tournament information"""
+    urlsafe_key = messages.StringField(1, required=True)
+    format = messages.StringField(2, required=True)
+    games_count = messages.IntegerField(3)
+    standings = messages.MessageField(StandingForm, 4, repeated=True)
+    winner_name = messages.StringField(5)
 
 
 class StringMessage(messages.Message):
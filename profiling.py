@@ -0,0 +1,219 @@
+"""profiling.py - Sampled per-request profiling of RPCs and latency.
+
+ProfilingMiddleware wraps a WSGI app and profiles a share of its requests,
+set by settings.PROFILING_SAMPLE_RATE. While a request is profiled, apiproxy
+hooks count and time every datastore, memcache and other RPC it makes, and
+functions decorated with timed() are timed as named sections; each RPC is
+attributed to the innermost section it was made from. Time spent outside
+the sections directly below the request (request decoding, dispatch and
+response encoding) is reported as serialization time.
+
+Each profile is logged as one JSON line and kept in a rolling window of the
+last SUMMARY_SIZE profiles per request path, summarized by summary(). A
+request that is not sampled only costs a thread local lookup per RPC and
+per timed call."""
+
+import collections
+import functools
+import json
+import logging
+import math
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+import settings
+
+SUMMARY_SIZE = 100
+HOOK_NAME = 'profiling'
+
+_local = threading.local()
+_lock = threading.Lock()
+_recent = {}  # Request path to a deque of its last profiles
+
+
+class _Profile(object):
+    """The measurements of one request"""
+
+    def __init__(self, name):
+        self.name = name
+        self.stack = [name]
+        self.sections = {}
+        self.started = {}  # id of a pending RPC request to (section, start)
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+        self.inner_seconds = 0.0
+
+    def section(self, name):
+        return self.sections.setdefault(
+                name, {'calls': 0, 'ms': 0.0, 'rpcs': {}})
+
+    def record(self, wall_seconds):
+        """Returns the profile as a JSON serializable dict"""
+        request = self.section(self.name)
+        request['calls'] = 1
+        request['ms'] = wall_seconds * 1000
+        serialization = None
+        if self.inner_seconds:
+            serialization = round((wall_seconds - self.inner_seconds) * 1000,
+                                  3)
+        sections = {}
+        for name, section in self.sections.items():
+            sections[name] = {
+                'calls': section['calls'],
+                'ms': round(section['ms'], 3),
+                'rpcs': dict((rpc, {'count': count, 'ms': round(ms, 3)})
+                             for rpc, (count, ms) in section['rpcs'].items()),
+            }
+        return {'request': self.name,
+                'wall_ms': round(wall_seconds * 1000, 3),
+                'serialization_ms': serialization,
+                'memcache_hits': self.memcache_hits,
+                'memcache_misses': self.memcache_misses,
+                'sections': sections}
+
+
+def _current():
+    return getattr(_local, 'profile', None)
+
+
+def _pre_call(service, call, request, response):
+    profile = _current()
+    if profile is not None:
+        profile.started[id(request)] = (profile.stack[-1], time.time())
+
+
+def _post_call(service, call, request, response):
+    profile = _current()
+    if profile is None:
+        return
+    section, start = profile.started.pop(id(request),
+                                         (profile.stack[-1], None))
+    rpc = profile.section(section)['rpcs'].setdefault(
+            '%s.%s' % (service, call), [0, 0.0])
+    rpc[0] += 1
+    if start is not None:
+        rpc[1] += (time.time() - start) * 1000
+    if service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        profile.memcache_hits += hits
+        profile.memcache_misses += request.key_size() - hits
+
+
+def _install_hooks():
+    """Adds the apiproxy hooks, once per process"""
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append(HOOK_NAME, _pre_call)
+    apiproxy.GetPostCallHooks().Append(HOOK_NAME, _post_call)
+
+
+def timed(name=None):
+    """Decorator timing a function as a section of the profiled request.
+    The section is named after the function unless a name is given."""
+    def decorator(function):
+        section_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profile = _current()
+            if profile is None:
+                return function(*args, **kwargs)
+            profile.stack.append(section_name)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                profile.stack.pop()
+                section = profile.section(section_name)
+                section['calls'] += 1
+                section['ms'] += elapsed * 1000
+                if len(profile.stack) == 1:
+                    profile.inner_seconds += elapsed
+        return wrapper
+    return decorator
+
+
+class ProfilingMiddleware(object):
+    """WSGI middleware profiling a sample of the requests of an app"""
+
+    def __init__(self, app):
+        self.app = app
+        _install_hooks()
+
+    def __call__(self, environ, start_response):
+        if random.random() >= settings.PROFILING_SAMPLE_RATE:
+            return self.app(environ, start_response)
+        profile = _Profile(environ.get('PATH_INFO', ''))
+        _local.profile = profile
+        start = time.time()
+        try:
+            return self.app(environ, start_response)
+        finally:
+            _local.profile = None
+            _finish(profile, time.time() - start)
+
+
+def _finish(profile, wall_seconds):
+    """Logs a profile and adds it to the rolling window"""
+    record = profile.record(wall_seconds)
+    logging.info('request_profile %s', json.dumps(record, sort_keys=True))
+    with _lock:
+        recent = _recent.get(profile.name)
+        if recent is None:
+            recent = _recent[profile.name] = collections.deque(
+                    maxlen=SUMMARY_SIZE)
+        recent.append(record)
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def summary():
+    """Returns the summary of the recent profiles of each request path:
+    wall time percentiles and the average time, RPC counts and RPC time of
+    each section per request."""
+    with _lock:
+        profiles = dict((name, list(recent))
+                        for name, recent in _recent.items())
+    result = {}
+    for name, records in profiles.items():
+        samples = len(records)
+        sections = {}
+        hits = misses = 0
+        for record in records:
+            hits += record['memcache_hits']
+            misses += record['memcache_misses']
+            for section_name, section in record['sections'].items():
+                total = sections.setdefault(section_name,
+                                            {'ms': 0.0, 'rpcs': {}})
+                total['ms'] += section['ms']
+                for rpc, stats in section['rpcs'].items():
+                    rpc_total = total['rpcs'].setdefault(
+                            rpc, {'count': 0, 'ms': 0.0})
+                    rpc_total['count'] += stats['count']
+                    rpc_total['ms'] += stats['ms']
+        for section in sections.values():
+            section['ms'] = round(section['ms'] / samples, 3)
+            for stats in section['rpcs'].values():
+                stats['count'] = round(float(stats['count']) / samples, 2)
+                stats['ms'] = round(stats['ms'] / samples, 3)
+        serialization = [record['serialization_ms'] for record in records
+                         if record['serialization_ms'] is not None]
+        walls = [record['wall_ms'] for record in records]
+        result[name] = {
+            'samples': samples,
+            'p50_wall_ms': _percentile(walls, 0.50),
+            'p99_wall_ms': _percentile(walls, 0.99),
+            'serialization_ms': (round(sum(serialization) /
+                                       len(serialization), 3)
+                                 if serialization else None),
+            'memcache_hit_ratio': (round(float(hits) / (hits + misses), 4)
+                                   if hits + misses else None),
+            'sections': sections,
+        }
+    return result
@@ -0,0 +1,133 @@
+"""reminders.py - Reminder email pipeline run by the hourly cron job.
+
+A run walks the active games in batches of BATCH_SIZE, one task queue task
+per batch. Each batch resolves the players of its games with one get_multi
+and merges a reminder line for every game into a ReminderDigest per user,
+so a user with many pending games gets a single email. Digests are child
+entities of the run's ReminderRun, and a batch writes its digests, the
+run's cursor and the task for the next batch in one transaction: a batch
+that fails is retried from the same cursor, and one that already committed
+is not applied twice. Once every game is collected, the digests are mailed
+the same way, SEND_BATCH_SIZE per task, and the run is deleted."""
+
+from datetime import datetime
+
+from google.appengine.api import app_identity, mail, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Game, ReminderRun, ReminderDigest
+
+COLLECT_URL = '/tasks/collect_reminders'
+SEND_URL = '/tasks/send_reminders'
+BATCH_SIZE = 100
+SEND_BATCH_SIZE = 50
+
+GAME_PROJECTION = [Game.x_user, Game.o_user, Game.moves_count]
+
+
+def start():
+    """Starts a reminder run"""
+    run = ReminderRun(id=datetime.now().strftime('%Y%m%d%H%M%S'),
+                      started=datetime.now())
+    run.put()
+    taskqueue.add(url=COLLECT_URL, params={'run': run.key.id()})
+
+
+def collect_batch(run_id):
+    """Merges the reminders of the next batch of active games into the
+    run's digests"""
+    run = ReminderRun.get_by_id(run_id)
+    if not run or run.collected:
+        return
+    start_cursor = run.cursor
+    games, next_cursor, more = Game.query(Game.game_over == False).fetch_page(
+            BATCH_SIZE, projection=GAME_PROJECTION,
+            start_cursor=Cursor(urlsafe=start_cursor) if start_cursor else None)
+
+    reminders = {}
+    users = dict((user.key, user) for user in ndb.get_multi(
+            list(set(key for game in games
+                     for key in (game.x_user, game.o_user)))) if user)
+    for game in games:
+        if (game.moves_count + 1) % 2 == 0:  # o_user is the next move
+            user_key, opponent_key = game.o_user, game.x_user
+        else:  # x_user is the next move
+            user_key, opponent_key = game.x_user, game.o_user
+        if user_key not in users or opponent_key not in users:
+            continue
+        if game.moves_count == 0:
+            line = 'Make your first move!'
+        else:
+            line = '{} just made a move.'.format(users[opponent_key].name)
+        reminders.setdefault(user_key, []).append(
+                (game.key, '{} (game {})'.format(line, game.key.urlsafe())))
+
+    @ndb.transactional
+    def _commit():
+        run = ReminderRun.get_by_id(run_id)
+        if run.collected or run.cursor != start_cursor:
+            return  # This batch was already committed
+        digest_keys = [ReminderDigest.key_for(run.key, user_key)
+                       for user_key in reminders]
+        digests = []
+        for key, digest, user_key in zip(digest_keys,
+                                         ndb.get_multi(digest_keys),
+                                         reminders):
+            user = users[user_key]
+            if not digest:
+                digest = ReminderDigest(key=key, name=user.name,
+                                        email=user.email)
+            for game_key, line in reminders[user_key]:
+                if game_key not in digest.game_keys:
+                    digest.game_keys.append(game_key)
+                    digest.lines.append(line)
+            digests.append(digest)
+        if more and next_cursor:
+            run.cursor = next_cursor.urlsafe()
+            taskqueue.add(url=COLLECT_URL, params={'run': run_id},
+                          transactional=True)
+        else:
+            run.collected = True
+            taskqueue.add(url=SEND_URL, params={'run': run_id},
+                          transactional=True)
+        ndb.put_multi(digests + [run])
+
+    _commit()
+
+
+def send_batch(run_id):
+    """Mails the next batch of the run's digests"""
+    run = ReminderRun.get_by_id(run_id)
+    if not run or not run.collected:
+        return
+    start_cursor = run.send_cursor
+    digests, next_cursor, more = ReminderDigest.query(
+            ancestor=run.key).fetch_page(
+            SEND_BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=start_cursor) if start_cursor else None)
+
+    sender = 'noreply@{}.appspotmail.com'.format(
+            app_identity.get_application_id())
+    for digest in digests:
+        # This will send test emails, the arguments to send_mail are:
+        # from, to, subject, body
+        mail.send_mail(sender, digest.email, 'This is a reminder!',
+                       digest.body())
+
+    if not (more and next_cursor):
+        ndb.delete_multi(ReminderDigest.query(ancestor=run.key).fetch(
+                keys_only=True) + [run.key])
+        return
+
+    @ndb.transactional
+    def _commit():
+        run = ReminderRun.get_by_id(run_id)
+        if run.send_cursor != start_cursor:
+            return  # This batch was already committed
+        run.send_cursor = next_cursor.urlsafe()
+        taskqueue.add(url=SEND_URL, params={'run': run_id},
+                      transactional=True)
+        run.put()
+
+    _commit()
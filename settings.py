@@ -12,3 +12,9 @@ WEB_CLIENT_ID = '237283753308-nkh41mag7421up45immq8pq233m898m7.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Share of the requests profiled by profiling.py, from 0 to 1
+PROFILING_SAMPLE_RATE = 0.01
+
+# Days after which finished games are moved to ArchivedGame by archival.py
+RETENTION_DAYS = 30
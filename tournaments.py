@@ -0,0 +1,173 @@
+"""tournaments.py - Tournament setup and bracket progression.
+
+Setting up a tournament resolves its users in one batch, gets the ids of
+all its games from one allocate_ids call and writes every Game, UserGame and
+TournamentStanding with one put_multi, so it costs a handful of RPCs however
+many games it has. A round robin creates a game for every pair of players.
+A bracket is single elimination: the first round is created at once, with
+byes for the best seeds when the number of players is not a power of two.
+The end_game transaction of a bracket game enqueues a task that moves its
+winner to the next round, creating the next game once both of its players
+are known; a drawn bracket game is replayed with the seats swapped."""
+
+from datetime import date
+
+from google.appengine.ext import ndb
+
+import counters
+from models import Game, Tournament, TournamentStanding, TournamentMatch
+from models import ACTIVE_GAMES
+
+ROUND_ROBIN = 'round_robin'
+BRACKET = 'bracket'
+FORMATS = (ROUND_ROBIN, BRACKET)
+MAX_PLAYERS = 64
+
+
+def round_robin_pairings(count):
+    """Returns the (x, o) player indexes of every game of a round robin of
+    count players. Each player plays X in about half of their games."""
+    return [(first, second) if (first + second) % 2 else (second, first)
+            for first in range(count) for second in range(first + 1, count)]
+
+
+def _rounds(count):
+    """Returns the number of rounds of a bracket of count players"""
+    rounds = 1
+    while 1 << rounds < count:
+        rounds += 1
+    return rounds
+
+
+def _seed_order(size):
+    """Returns the seeds of a bracket of size players in slot order, so the
+    best seeds meet as late as possible"""
+    order = [0]
+    while len(order) < size:
+        count = len(order) * 2
+        order = [seed for best in order for seed in (best, count - 1 - best)]
+    return order
+
+
+def _build_games(tournament_key, pairings, first_id):
+    """Returns the Game and UserGame entities of (x_user, o_user, match)
+    pairings, with consecutive ids from first_id"""
+    entities = []
+    for game_id, (x_user, o_user, match) in enumerate(pairings, first_id):
+        game_key = ndb.Key(Game, game_id)
+        entities.extend(Game.build(
+                game_key, x_user, o_user, tournament=tournament_key,
+                tournament_match=match.key if match else None))
+        if match:
+            match.game = game_key
+    return entities
+
+
+def _advance(tournament, rounds, matches, match, winner, pairings):
+    """Records the winner of a match and seats them in the next round.
+    matches holds the matches known so far by key; the pairing of a next
+    round match whose players are both known is added to pairings."""
+    match.winner = winner
+    if match.round + 1 == rounds:
+        tournament.winner = winner
+        return
+    key = TournamentMatch.key_for(tournament.key, match.round + 1,
+                                  match.slot // 2)
+    following = matches.get(key)
+    if not following:
+        following = matches[key] = TournamentMatch(
+                key=key, round=match.round + 1, slot=match.slot // 2)
+    if match.slot % 2 == 0:
+        following.x_user = winner
+    else:
+        following.o_user = winner
+    if following.x_user and following.o_user:
+        pairings.append((following.x_user, following.o_user, following))
+
+
+def _first_round(tournament):
+    """Returns the matches and pairings of the first round of a bracket"""
+    players = tournament.players
+    rounds = _rounds(len(players))
+    size = 1 << rounds
+    order = _seed_order(size)
+    matches = {}
+    pairings = []
+    byes = []
+    for slot in range(size // 2):
+        match = TournamentMatch(
+                key=TournamentMatch.key_for(tournament.key, 0, slot),
+                round=0, slot=slot, x_user=players[order[2 * slot]])
+        matches[match.key] = match
+        if order[2 * slot + 1] < len(players):
+            match.o_user = players[order[2 * slot + 1]]
+            pairings.append((match.x_user, match.o_user, match))
+        else:
+            byes.append(match)
+    for match in byes:
+        _advance(tournament, rounds, matches, match, match.x_user, pairings)
+    return matches.values(), pairings
+
+
+def create(user_keys, names, tournament_format):
+    """Creates a tournament between users, seeded in order, and its games.
+    Returns the Tournament and its standings."""
+    tournament = Tournament(id=Tournament.allocate_ids(1)[0],
+                            format=tournament_format,
+                            players=user_keys,
+                            date=date.today())
+    standings = [TournamentStanding(
+                     key=TournamentStanding.key_for(tournament.key, key),
+                     user=key, name=name)
+                 for key, name in zip(user_keys, names)]
+    if tournament_format == ROUND_ROBIN:
+        matches = []
+        pairings = [(user_keys[x], user_keys[o], None)
+                    for x, o in round_robin_pairings(len(user_keys))]
+    else:
+        matches, pairings = _first_round(tournament)
+    first_id, last_id = Game.allocate_ids(len(pairings))
+    games = _build_games(tournament.key, pairings, first_id)
+    tournament.games_count = len(pairings)
+    ndb.put_multi([tournament] + standings + matches + games)
+    counters.increment({ACTIVE_GAMES: len(pairings)})
+    return tournament, standings
+
+
+def advance(game_key, winner):
+    """Moves the winner of a bracket game to the next round, or replays the
+    game if winner is None. Run by the task end_game enqueues; a task run
+    again for the same game changes nothing."""
+    game = game_key.get()
+    if not game or not game.tournament_match:
+        return
+    game_id = Game.allocate_ids(1)[0]
+
+    @ndb.transactional(xg=True)
+    def _advance_match():
+        tournament, match = ndb.get_multi([game.tournament,
+                                           game.tournament_match])
+        if match.game != game_key or match.winner:
+            return 0  # Already advanced
+        matches = {match.key: match}
+        pairings = []
+        if winner:
+            rounds = _rounds(len(tournament.players))
+            if match.round + 1 < rounds:
+                key = TournamentMatch.key_for(tournament.key, match.round + 1,
+                                              match.slot // 2)
+                following = key.get()
+                if following:
+                    matches[key] = following
+            _advance(tournament, rounds, matches, match, winner, pairings)
+        else:
+            match.x_user, match.o_user = match.o_user, match.x_user
+            pairings.append((match.x_user, match.o_user, match))
+        games = _build_games(tournament.key, pairings, game_id)
+        tournament.games_count += len(pairings)
+        ndb.put_multi([tournament] + matches.values() + games)
+        return len(pairings)
+
+    created = _advance_match()
+    if created:
+        counters.increment({ACTIVE_GAMES: created})
@@ -1,9 +1,17 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+import profiling
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+@profiling.timed()
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
         that the type of entity returned is of the correct kind. Raises an
@@ -17,6 +25,15 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
+    return get_by_urlsafe_async(urlsafe, model).get_result()
+
+
+def get_by_urlsafe_async(urlsafe, model):
+    """Returns a future of get_by_urlsafe(urlsafe, model), so the entity can
+        be fetched concurrently with other lookups. A malformed key string
+        raises at once rather than from the future.
+    Raises:
+        endpoints.BadRequestException: The key string is malformed."""
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
@@ -26,10 +43,66 @@ def get_by_urlsafe(urlsafe, model):
             raise endpoints.BadRequestException('Invalid Key')
         else:
             raise
+    return _get_of_kind(key, model)
 
-    entity = key.get()
+
+@ndb.tasklet
+def _get_of_kind(key, model):
+    entity = yield key.get_async()
     if not entity:
-        return None
+        raise ndb.Return(None)
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
-    return entity      
\ No newline at end of file
+    raise ndb.Return(entity)
+
+
+def _page_size(limit):
+    """Returns the page size of a requested limit. Defaults to
+    DEFAULT_PAGE_SIZE and is capped at MAX_PAGE_SIZE."""
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    if limit < 1:
+        raise endpoints.BadRequestException('limit must be at least 1')
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def fetch_page(query, limit, urlsafe_cursor, **options):
+    """Fetches one page of query results.
+    Args:
+        query: The ndb.Query to run
+        limit: The requested page size. Defaults to DEFAULT_PAGE_SIZE and is
+            capped at MAX_PAGE_SIZE.
+        urlsafe_cursor: The next_cursor of the previous page, or None for the
+            first page
+        options: Further query options such as projection
+    Returns:
+        A (results, next_cursor) tuple. next_cursor is a urlsafe string, or
+        None if there are no more results.
+    Raises:
+        endpoints.BadRequestException: The limit is below 1, or the cursor
+            string is malformed or belongs to another query."""
+    limit = _page_size(limit)
+    try:
+        cursor = Cursor(urlsafe=urlsafe_cursor) if urlsafe_cursor else None
+        results, next_cursor, more = query.fetch_page(
+                limit, start_cursor=cursor, **options)
+    except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+        raise endpoints.BadRequestException('Invalid cursor')
+    if more and next_cursor:
+        return results, next_cursor.urlsafe()
+    return results, None
+
+
+def page_list(items, limit, urlsafe_cursor):
+    """Returns one page of a list the way fetch_page does for a query. The
+    cursor of a list page is the offset of the page's first item.
+    Raises:
+        endpoints.BadRequestException: The limit is below 1 or the cursor
+            string is malformed."""
+    limit = _page_size(limit)
+    if urlsafe_cursor and not urlsafe_cursor.isdigit():
+        raise endpoints.BadRequestException('Invalid cursor')
+    start = int(urlsafe_cursor or 0)
+    if start + limit < len(items):
+        return items[start:start + limit], str(start + limit)
+    return items[start:start + limit], None
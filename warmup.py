@@ -0,0 +1,71 @@
+"""warmup.py - Warmup of new instances.
+
+App Engine sends /_ah/warmup (see app.yaml) to a new instance before it
+routes user requests there. warm() imports the API module, which builds
+endpoints, protorpc, every ResourceContainer and the engine tables, solves
+the computer player's table of replies, then primes the memcache entries
+the first requests read: the top page of user rankings and the user keys of
+the players of active games. Each startup phase is timed; the timings of
+the instance are kept in timings and logged as one JSON line."""
+
+import collections
+import json
+import logging
+import time
+
+from google.appengine.api import memcache
+
+from models import Game, user_names, MEMCACHE_USER_KEY
+
+ACTIVE_GAMES_TO_WARM = 200
+
+timings = collections.OrderedDict()  # Startup phase to milliseconds
+
+
+def record(phase, started):
+    """Records the time a startup phase took since started, a time.time()
+    value"""
+    timings[phase] = round((time.time() - started) * 1000, 3)
+
+
+def _import_api():
+    global api
+    import api
+
+
+def _solve_computer_player():
+    import ai
+    ai.best_replies()
+
+
+def _cache_top_rankings():
+    api.top_rankings()
+
+
+def _cache_active_user_keys():
+    """Adds the name to key entries of User.key_for_name for the players of
+    active games"""
+    # The projection of the reminder batches, so the same index serves it
+    games = Game.query(Game.game_over == False).fetch(
+            ACTIVE_GAMES_TO_WARM,
+            projection=[Game.x_user, Game.o_user, Game.moves_count])
+    names = user_names(key for game in games
+                       for key in (game.x_user, game.o_user))
+    memcache.add_multi(dict((name, key.urlsafe())
+                            for key, name in names.items()),
+                       key_prefix=MEMCACHE_USER_KEY % '')
+
+
+def warm():
+    """Runs every startup phase. Returns the timings of the instance."""
+    started = time.time()
+    for phase, function in (('import_api', _import_api),
+                            ('computer_player', _solve_computer_player),
+                            ('top_rankings', _cache_top_rankings),
+                            ('active_user_keys', _cache_active_user_keys)):
+        phase_started = time.time()
+        function()
+        record(phase, phase_started)
+    record('warmup', started)
+    logging.info('startup_timings %s', json.dumps(timings))
+    return timings